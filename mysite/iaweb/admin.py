@@ -1,12 +1,23 @@
+import uuid
+
 from django.contrib import admin, messages
+from django.contrib.admin.views.main import ORDER_VAR
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.http import JsonResponse
+from django.urls import path
+from django.utils.functional import cached_property
 from django.utils.html import format_html
 
 # ─── helpers para stitching ──────────────────────────────────────
-from .utils_stitch import stitch_circular, stitch_cropped, save_mosaic
+from .utils_jobs import enqueue_stitch
+from .utils_stitch import rejected_frames_q, usable_frames_q
+from .utils_thumbs import thumbnail_url
 
 from .models import (
     Patient, Sample, DiagnosisReport, Disease,
-    SampleImage, HealthCenter, SampleImageVisualizer
+    SampleImage, HealthCenter, SampleImageVisualizer, StitchJob
 )
 
 # =====================================================================
@@ -32,45 +43,70 @@ class SampleAdmin(ModelAdmin):
     search_fields = ('sample_type', 'patient__name')
 
     # ─── acciones de stitching ───────────────────────────────────
+    # Solo encolan: el trabajo lo hace `manage.py run_stitch_worker`.
+    def _enqueue(self, request, queryset, kind):
+        created = 0
+        for sample in queryset:
+            _, is_new = enqueue_stitch(sample, kind)
+            created += is_new
+        skipped = len(queryset) - created
+        self.message_user(
+            request,
+            f"{created} mosaicos {kind} encolados"
+            + (f" ({skipped} ya estaban en cola)" if skipped else ""),
+            level=messages.SUCCESS
+        )
+
     @admin.action(description="Stitch circular mosaic")
     def make_stitch_circular(self, request, queryset):
-        for sample in queryset:
-            try:
-                pano = stitch_circular(sample)
-                save_mosaic(sample, pano, "circular")
-                self.message_user(
-                    request,
-                    f"Mosaico circular creado para {sample.id}",
-                    level=messages.SUCCESS
-                )
-            except Exception as exc:
-                self.message_user(
-                    request,
-                    f"{sample.id}: {exc}",
-                    level=messages.ERROR
-                )
+        self._enqueue(request, queryset, StitchJob.CIRCULAR)
 
     @admin.action(description="Stitch cropped mosaic")
     def make_stitch_cropped(self, request, queryset):
-        for sample in queryset:
-            try:
-                pano = stitch_cropped(sample)
-                save_mosaic(sample, pano, "cropped")
-                self.message_user(
-                    request,
-                    f"Mosaico cropped creado para {sample.id}",
-                    level=messages.SUCCESS
-                )
-            except Exception as exc:
-                self.message_user(
-                    request,
-                    f"{sample.id}: {exc}",
-                    level=messages.ERROR
-                )
+        self._enqueue(request, queryset, StitchJob.CROPPED)
 
     actions = ["make_stitch_circular", "make_stitch_cropped"]
 
 
+# =====================================================================
+# TRABAJOS DE STITCHING (estado de la cola)
+# =====================================================================
+@admin.register(StitchJob)
+class StitchJobAdmin(ModelAdmin):
+    list_display = ('id', 'sample', 'kind', 'status', 'progress',
+                    'attempts', 'mosaic_link', 'date_created',
+                    'date_finished')
+    list_filter = ('status', 'kind')
+    readonly_fields = [f.name for f in StitchJob._meta.fields]
+    actions = ['retry_jobs']
+
+    def has_add_permission(self, request):
+        return False
+
+    def progress(self, obj):
+        if not obj.frames_total:
+            return '-'
+        return (f"{obj.frames_scanned}/{obj.frames_total} revisados, "
+                f"{obj.frames_kept} útiles")
+
+    progress.short_description = 'Progress'
+
+    def mosaic_link(self, obj):
+        if obj.mosaic and obj.mosaic.image:
+            return format_html('<a href="{}" target="_blank">ver</a>',
+                               obj.mosaic.image.url)
+        return '-'
+
+    mosaic_link.short_description = 'Mosaic'
+
+    @admin.action(description="Retry selected jobs")
+    def retry_jobs(self, request, queryset):
+        n = queryset.filter(status=StitchJob.FAILED).update(
+            status=StitchJob.PENDING, attempts=0, retry_after=None)
+        self.message_user(request, f"{n} trabajos reencolados",
+                          level=messages.SUCCESS)
+
+
 # =====================================================================
 # CENTROS DE SALUD
 # =====================================================================
@@ -105,12 +141,14 @@ class DiagnosisReportAdmin(admin.ModelAdmin):
                                    extra_context=extra_context)
 
     def sample_images_image_field(self, obj):
-        images = obj.sample.images.all()
+        images = obj.sample.images.only('id', 'image', 'detected_image')
         image_tags = [
             format_html(
-                '<a href="{0}" target="_blank"><img src="{0}" width="50" '
-                'height="50" /><br /></a>',
-                image.detected_image.url
+                '<a href="{0}" target="_blank"><img src="{1}" width="50" '
+                'height="50" loading="lazy" /><br /></a>',
+                (image.detected_image or image.image).url,
+                thumbnail_url(image, field='detected' if image.detected_image
+                              else 'image')
             ) for image in images
         ]
         return format_html(' '.join(image_tags))
@@ -130,16 +168,36 @@ class DiagnosisReportAdmin(admin.ModelAdmin):
 # =====================================================================
 # IMÁGENES DE MUESTRA (listado clásico)
 # =====================================================================
+class UsableFrameFilter(admin.SimpleListFilter):
+    """Filtra con las métricas precalculadas en la ingesta (FrameFeatures)."""
+    title = 'quality'
+    parameter_name = 'quality'
+
+    def lookups(self, request, model_admin):
+        return (('usable', 'Usable'), ('rejected', 'Rejected'),
+                ('pending', 'Not analysed yet'))
+
+    def queryset(self, request, queryset):
+        if self.value() == 'usable':
+            return queryset.filter(usable_frames_q())
+        if self.value() == 'rejected':
+            return queryset.filter(rejected_frames_q())
+        if self.value() == 'pending':
+            return queryset.filter(is_mosaic=False, features__isnull=True)
+        return queryset
+
+
 @admin.register(SampleImage)
 class SampleImageAdmin(admin.ModelAdmin):
     list_display = ('id', 'sample', 'image_thumbnail', 'date_published')
+    list_filter = (UsableFrameFilter,)
     actions = ['show_selected_images']
 
     def image_thumbnail(self, obj):
         if obj.image:
             return format_html(
-                '<img src="{}" style="height: 50px;" />',
-                obj.image.url
+                '<img src="{}" style="height: 50px;" loading="lazy" />',
+                thumbnail_url(obj)
             )
         return '-'
 
@@ -147,7 +205,8 @@ class SampleImageAdmin(admin.ModelAdmin):
 
     def show_selected_images(self, request, queryset):
         images_html = ''.join(
-            f'<img src="{img.image.url}" style="height: 150px; margin: 5px;" />'
+            f'<img src="{thumbnail_url(img, "m")}" '
+            f'style="height: 150px; margin: 5px;" />'
             for img in queryset
         )
         self.message_user(request, format_html(images_html))
@@ -158,11 +217,38 @@ class SampleImageAdmin(admin.ModelAdmin):
 # =====================================================================
 # ────────  VISUALIZER   ─────────────────────────────────────────────
 # =====================================================================
+class KeysetPaginator(Paginator):
+    """Sin COUNT(*) ni OFFSET: la página son siempre las ``per_page``
+    primeras filas del queryset, que ya viene filtrado a partir del cursor
+    (ver ``SampleImageVisualizerAdmin.get_queryset``)."""
+
+    def __init__(self, object_list, per_page, *args, **kwargs):
+        super().__init__(object_list, per_page, *args, **kwargs)
+        # una fila de más para saber si hay página siguiente
+        self.rows = list(object_list[:per_page + 1])
+        self.has_more = len(self.rows) > per_page
+
+    @cached_property
+    def count(self):
+        return len(self.rows)
+
+    @property
+    def last(self):
+        """Última fila de la página si hay siguiente (el cursor)."""
+        return self.rows[self.per_page - 1] if self.has_more else None
+
+    def page(self, number):
+        return self._get_page(self.rows[:self.per_page], 1, self)
+
+
 @admin.register(SampleImageVisualizer)
 class SampleImageVisualizerAdmin(admin.ModelAdmin):
     """
     Vista especial que muestra solo las sub-imágenes de una muestra
-    seleccionada mediante un <select>.
+    seleccionada con un buscador (autocompletado en JSON).
+
+    Paginación por clave (``after=<is_mosaic>:<id>``): el coste de cada
+    página no depende del tamaño del archivo.
     """
     change_list_template = "admin/iaweb/sample_visualizer_changelist.html"
 
@@ -170,16 +256,25 @@ class SampleImageVisualizerAdmin(admin.ModelAdmin):
                     'patient_name', 'date_published')
     list_select_related = ('sample__patient',)
     list_per_page = 300
-    ordering = ('sample', 'id')
+    # frames y luego mosaicos: recorre el índice (sample, is_mosaic, id)
+    ordering = ('sample', 'is_mosaic', 'id')
     list_filter = ()
     actions = None
+    paginator = KeysetPaginator
+    show_full_result_count = False
+    # el paginador no cuenta (count = filas de esta página): sin "Show all"
+    list_max_show_all = 0
+    # el cursor supone el orden (is_mosaic, id): columnas sin ordenar
+    sortable_by = ()
+    autocomplete_limit = 20
 
     # ────────────── helpers ──────────────
     def thumbnail(self, obj):
         if obj.image:
             return format_html(
-                '<img src="{}" style="height:60px;border-radius:4px;" />',
-                obj.image.url
+                '<img src="{}" style="height:60px;border-radius:4px;" '
+                'height="60" loading="lazy" decoding="async" />',
+                thumbnail_url(obj)
             )
         return '-'
 
@@ -190,26 +285,68 @@ class SampleImageVisualizerAdmin(admin.ModelAdmin):
 
     patient_name.short_description = 'Patient'
 
-    # ────────────── filtrado por muestra ──────────────
+    # ────────────── buscador de muestras (JSON) ──────────────
+    def get_urls(self):
+        info = self.opts.app_label, self.opts.model_name
+        return [
+            path('samples/',
+                 self.admin_site.admin_view(self.sample_autocomplete),
+                 name='%s_%s_samples' % info),
+        ] + super().get_urls()
+
+    def sample_autocomplete(self, request):
+        """Muestras por nombre de paciente o inicio del id (``?q=``)."""
+        q = request.GET.get('q', '').strip()
+        samples = (Sample.objects.select_related('patient')
+                   .only('id', 'date_published', 'patient__name')
+                   .order_by('-date_published'))
+        if q:
+            samples = samples.filter(Q(patient__name__icontains=q)
+                                     | Q(id__istartswith=q))
+        return JsonResponse({'results': [
+            {'id': str(s.id), 'text': f"{s.id} — {s.patient.name}",
+             'date': s.date_published.date().isoformat()}
+            for s in samples[:self.autocomplete_limit]
+        ]})
+
+    # ────────────── filtrado por muestra + cursor ──────────────
     def get_queryset(self, request):
         qs = super().get_queryset(request)
-        sample_id = request.GET.get("sample")
-        if sample_id:
-            qs = qs.filter(sample_id=sample_id)
-        else:
-            first_sample = Sample.objects.order_by("date_published").first()
-            if first_sample:
-                qs = qs.filter(sample=first_sample)
-        return qs
+        params = getattr(request, 'visualizer', None)
+        if params is None:          # vistas de detalle: sin filtrar
+            return qs
+        qs = qs.filter(sample_id=params['sample'])
+        mosaic, _, pk = (params['after'] or '').partition(':')
+        try:
+            pk = uuid.UUID(pk)
+        except ValueError:
+            return qs
+        if mosaic == '1':
+            return qs.filter(is_mosaic=True, id__gt=pk)
+        return qs.filter(Q(is_mosaic=False, id__gt=pk) | Q(is_mosaic=True))
 
     def changelist_view(self, request, extra_context=None):
+        # parámetros propios: fuera de GET para que el ChangeList no los
+        # tome por filtros del admin
+        request.GET = request.GET.copy()
+        sample_id = request.GET.pop('sample', [None])[-1]
+        after = request.GET.pop('after', [None])[-1]
+        # ?o= cambiaría el ORDER BY por debajo del cursor
+        request.GET.pop(ORDER_VAR, None)
+
+        sample = (Sample.objects.select_related('patient')
+                  .only('id', 'date_published', 'patient__name')
+                  .order_by('-date_published'))
+        try:
+            sample = (sample.filter(pk=sample_id) if sample_id
+                      else sample).first()
+        except ValidationError:
+            sample = None
+        request.visualizer = {'sample': sample.pk if sample else None,
+                              'after': after}
+
         extra_context = extra_context or {}
-        samples = Sample.objects.select_related("patient")\
-                                .order_by("-date_published")
-        extra_context["samples"] = samples
-        extra_context["selected_sample"] = request.GET.get(
-            "sample",
-            samples.first().id if samples else None
-        )
+        extra_context["selected_sample"] = sample
+        extra_context["after"] = after
         return super().changelist_view(request,
                                        extra_context=extra_context)
@@ -8,4 +8,5 @@ class IawebConfig(AppConfig):
     
     def ready(self):
         import iaweb.signals
+        import iaweb.utils_db       # PRAGMAs de SQLite en cada conexión
     
@@ -0,0 +1,183 @@
+import os
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, transaction
+
+from iaweb import utils_db
+
+ROWS_TABLE = "iaweb_benchmark_rows"
+TOTAL_TABLE = "iaweb_benchmark_total"
+PAYLOAD = "x" * 512
+
+# modos de SQLite a comparar: los PRAGMAs de utils_db o el journal clásico
+SQLITE_MODES = {
+    "wal": utils_db.SQLITE_PRAGMAS,
+    "rollback": {"journal_mode": "DELETE", "synchronous": "FULL"},
+}
+
+
+class SQLiteTarget:
+    """Base de datos temporal en la carpeta de la configurada (mismo
+    disco), con los PRAGMAs de un modo. La BD real no se toca."""
+
+    def __init__(self, settings_dict, pragmas):
+        timeout = settings_dict.get("OPTIONS", {}).get("timeout", 5)
+        self.pragmas = {**pragmas, "busy_timeout": int(timeout * 1000)}
+        self.begin = "BEGIN " + settings_dict.get("OPTIONS", {}).get(
+            "transaction_mode", "DEFERRED")
+        fd, self.path = tempfile.mkstemp(
+            suffix=".sqlite3", prefix="benchmark_",
+            dir=os.path.dirname(os.path.abspath(settings_dict["NAME"])))
+        os.close(fd)
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None,
+                               check_same_thread=False)
+        utils_db.apply_pragmas(conn, self.pragmas)
+        return conn
+
+    def setup(self):
+        conn = self.connect()
+        try:
+            _create_tables(conn)
+        finally:
+            conn.close()
+
+    def write(self, conn, worker):
+        try:
+            conn.execute(self.begin)
+            _write(conn, worker, "?")
+            conn.execute("COMMIT")
+        except sqlite3.OperationalError:    # "database is locked"
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+    def teardown(self):
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            try:
+                os.remove(self.path + suffix)
+            except FileNotFoundError:
+                pass
+
+
+class DjangoTarget:
+    """Tablas propias en la base de datos configurada (PostgreSQL…); se
+    borran antes de crearlas por si una ejecución anterior se cortó."""
+
+    def connect(self):
+        return None
+
+    def setup(self):
+        self.teardown()
+        with connection.cursor() as cursor:
+            _create_tables(cursor)
+
+    def write(self, conn, worker):
+        with transaction.atomic(), connection.cursor() as cursor:
+            _write(cursor, worker, "%s")
+
+    def teardown(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {ROWS_TABLE}")
+            cursor.execute(f"DROP TABLE IF EXISTS {TOTAL_TABLE}")
+
+
+def _create_tables(cursor):
+    cursor.execute(f"CREATE TABLE {ROWS_TABLE} "
+                   f"(worker integer NOT NULL, payload text NOT NULL)")
+    cursor.execute(f"CREATE TABLE {TOTAL_TABLE} (n integer NOT NULL)")
+    cursor.execute(f"INSERT INTO {TOTAL_TABLE} (n) VALUES (0)")
+
+
+def _write(cursor, worker, placeholder):
+    cursor.execute(f"INSERT INTO {ROWS_TABLE} (worker, payload) "
+                   f"VALUES ({placeholder}, {placeholder})", [worker, PAYLOAD])
+    cursor.execute(f"UPDATE {TOTAL_TABLE} SET n = n + 1")
+
+
+class Command(BaseCommand):
+    help = ("Mide el rendimiento de escritura (transacciones/s) de la base "
+            "de datos configurada con varios escritores concurrentes. Cada "
+            "transacción inserta una fila y actualiza un contador compartido, "
+            "como una subida. En SQLite usa una base de datos temporal junto "
+            "a la configurada, con los PRAGMAs de cada modo; en los demás "
+            "motores, tablas propias que borra al terminar.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, action='append',
+                            default=[],
+                            help="Escritores concurrentes (repetible).")
+        parser.add_argument('--ops', type=int, default=200,
+                            help="Transacciones por escritor.")
+        parser.add_argument('--mode', action='append', default=[],
+                            choices=sorted(SQLITE_MODES),
+                            help="Solo SQLite: modos a comparar (repetible).")
+
+    def _writer(self, target, worker, ops, latencies, errors, start):
+        conn = target.connect()
+        start.wait()
+        try:
+            for _ in range(ops):
+                t0 = time.perf_counter()
+                try:
+                    target.write(conn, worker)
+                except (OperationalError, sqlite3.OperationalError):
+                    errors.append(worker)
+                    continue
+                latencies.append(time.perf_counter() - t0)
+        finally:
+            (conn or connection).close()
+
+    def _round(self, target, writers, ops):
+        latencies, errors = [], []
+        start = threading.Barrier(writers + 1)
+        threads = [threading.Thread(target=self._writer,
+                                    args=(target, i, ops, latencies, errors,
+                                          start))
+                   for i in range(writers)]
+        for t in threads:
+            t.start()
+        start.wait()
+        t0 = time.perf_counter()
+        for t in threads:
+            t.join()
+        return latencies, errors, time.perf_counter() - t0
+
+    def handle(self, *args, **options):
+        writers = options['writers'] or [1, 4, 16]
+        if connection.vendor == 'sqlite':
+            if ':memory:' in str(connection.settings_dict['NAME']):
+                raise CommandError("SQLite en memoria: nada que medir.")
+            modes = options['mode'] or ['rollback', 'wal']
+        elif options['mode']:
+            raise CommandError("--mode solo aplica a SQLite.")
+        else:
+            modes = [connection.vendor]
+
+        self.stdout.write(f"{'modo':<10} {'escrit.':>7} {'tx/s':>8} "
+                          f"{'p50 (ms)':>9} {'p95 (ms)':>9} {'errores':>8}")
+        for mode in modes:
+            target = (SQLiteTarget(connection.settings_dict,
+                                   SQLITE_MODES[mode])
+                      if mode in SQLITE_MODES else DjangoTarget())
+            try:
+                target.setup()
+                for n in writers:
+                    latencies, errors, wall = self._round(target, n,
+                                                          options['ops'])
+                    latencies.sort()
+                    p50 = statistics.median(latencies) if latencies else 0
+                    p95 = (latencies[int(len(latencies) * 0.95) - 1]
+                           if latencies else 0)
+                    self.stdout.write(
+                        f"{mode:<10} {n:>7} {len(latencies) / wall:>8.1f} "
+                        f"{p50 * 1000:>9.1f} {p95 * 1000:>9.1f} "
+                        f"{len(errors):>8}")
+            finally:
+                target.teardown()
@@ -0,0 +1,73 @@
+import glob
+import os
+import time
+
+import cv2
+from django.core.management.base import BaseCommand, CommandError
+
+from iaweb.models import SampleImage
+from iaweb import utils_detect
+
+
+class Command(BaseCommand):
+    help = ("Mide el rendimiento (frames/s) del detector en CPU para varias "
+            "combinaciones de hilos y tamaño de lote, sin guardar nada.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', default=None,
+                            help="Modelo ONNX (por defecto DETECT_MODEL).")
+        parser.add_argument('--backend', action='append', default=[],
+                            choices=utils_detect.DETECT_BACKENDS,
+                            help="Backends a probar (repetible).")
+        parser.add_argument('--threads', type=int, action='append',
+                            default=[], help="Hilos a probar (repetible).")
+        parser.add_argument('--batch', type=int, action='append', default=[],
+                            help="Tamaños de lote a probar (repetible).")
+        parser.add_argument('--frames', type=int, default=32,
+                            help="Frames por medición.")
+        parser.add_argument('--dir', default=None,
+                            help="Carpeta de imágenes (si no, las de la BD).")
+
+    def _images(self, options):
+        if options['dir']:
+            paths = sorted(glob.glob(os.path.join(options['dir'], '*')))
+        else:
+            paths = [simg.image.path for simg in SampleImage.objects
+                     .filter(is_mosaic=False)[:options['frames']]]
+        images = [img for img in map(cv2.imread, paths[:options['frames']])
+                  if img is not None]
+        if not images:
+            raise CommandError("No hay imágenes para medir.")
+        while len(images) < options['frames']:
+            images += images[:options['frames'] - len(images)]
+        return images
+
+    def handle(self, *args, **options):
+        model = options['model'] or utils_detect.DETECT_MODEL
+        if not os.path.exists(model):
+            raise CommandError(f"No existe el modelo {model}.")
+        images = self._images(options)
+        backends = options['backend'] or [utils_detect.DETECT_BACKEND]
+        threads = options['threads'] or [utils_detect.DETECT_THREADS]
+        batches = options['batch'] or [1, utils_detect.DETECT_BATCH]
+
+        self.stdout.write(f"{len(images)} frames, {os.cpu_count()} CPUs\n")
+        self.stdout.write(f"{'backend':<12} {'hilos':>5} {'lote':>5} "
+                          f"{'prep fps':>9} {'infer fps':>10} {'total fps':>10}")
+        for backend in backends:
+            for n_threads in threads:
+                detector = utils_detect.Detector(model, backend, n_threads)
+                detector.detect(images[:1])         # calentamiento
+                for batch in batches:
+                    t0 = time.perf_counter()
+                    prepared = [detector.prepare(img) for img in images]
+                    t_prep = time.perf_counter() - t0
+                    t0 = time.perf_counter()
+                    for i in range(0, len(prepared), batch):
+                        detector.detect_prepared(prepared[i:i + batch])
+                    t_inf = time.perf_counter() - t0
+                    n = len(images)
+                    self.stdout.write(
+                        f"{backend:<12} {n_threads:>5} {batch:>5} "
+                        f"{n / t_prep:>9.1f} {n / t_inf:>10.1f} "
+                        f"{n / (t_prep + t_inf):>10.1f}")
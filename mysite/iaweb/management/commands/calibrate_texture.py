@@ -0,0 +1,102 @@
+import random
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from iaweb.models import SampleImage
+from iaweb import utils_stitch
+
+
+def best_threshold(scores, rejected):
+    """Umbral ``t`` tal que ``score < t`` coincide más veces con ``rejected``.
+
+    ``t`` queda a medio camino entre los dos scores que separa (el
+    redondeo de la sugerencia no mueve ningún frame de lado).
+    Devuelve ``(t, aciertos)``.
+    """
+    order = np.argsort(scores, kind="stable")
+    s = np.asarray(scores, dtype=float)[order]
+    r = np.asarray(rejected, dtype=bool)[order]
+    n = len(s)
+
+    # con el corte en la posición i se descartan s[:i]
+    rej_below = np.concatenate(([0], np.cumsum(r)))
+    keep_above = (~r).sum() - np.concatenate(([0], np.cumsum(~r)))
+    hits = rej_below + keep_above
+
+    # solo son cortes válidos los que no parten un grupo de empates
+    valid = np.ones(n + 1, dtype=bool)
+    valid[1:n] = s[1:] != s[:-1]
+    i = int(np.argmax(np.where(valid, hits, -1)))
+    if i == 0:
+        t = s[0]
+    elif i == n:
+        t = s[-1] + 1
+    else:
+        t = (s[i - 1] + s[i]) / 2
+    return float(t), int(hits[i])
+
+
+class Command(BaseCommand):
+    help = ("Ajusta el umbral de cada backend de textura para que reproduzca "
+            "las decisiones de SIFT sobre las imágenes existentes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sample', action='append', default=[],
+                            help="Limita a estas muestras (repetible).")
+        parser.add_argument('--limit', type=int, default=500,
+                            help="Máximo de frames a evaluar (al azar).")
+
+    def handle(self, *args, **options):
+        images = SampleImage.objects.filter(is_mosaic=False)
+        if options['sample']:
+            images = images.filter(sample_id__in=options['sample'])
+        ids = list(images.values_list('id', flat=True))
+        if options['limit'] and len(ids) > options['limit']:
+            ids = random.sample(ids, options['limit'])
+        if not ids:
+            raise CommandError("No hay imágenes que evaluar.")
+
+        backends = list(utils_stitch.TEXTURE_BACKENDS)
+        scores = {b: [] for b in backends}
+        timing = dict.fromkeys(backends, 0.0)
+
+        for simg in SampleImage.objects.filter(id__in=ids):
+            mini = utils_stitch._gray_mini(simg.image.path)
+            # la textura solo decide en frames que pasan negro/blanco
+            black, white = utils_stitch._gray_ratios([mini])
+            if black[0] >= utils_stitch.BLACK_RATIO \
+                    or white[0] >= utils_stitch.WHITE_RATIO:
+                continue
+            for b in backends:
+                t0 = time.perf_counter()
+                scores[b].append(utils_stitch._texture_score(mini, b))
+                timing[b] += time.perf_counter() - t0
+
+        n = len(scores["sift"])
+        if not n:
+            raise CommandError("Ningún frame pasa los filtros negro/blanco.")
+        reference = [s < utils_stitch.MIN_KEYPOINTS for s in scores["sift"]]
+        self.stdout.write(f"{n} frames evaluados, "
+                          f"{sum(reference)} descartados por SIFT.\n")
+
+        self.stdout.write(f"{'backend':<10} {'umbral':>10} {'acuerdo':>8} "
+                          f"{'ms/frame':>9} {'vs SIFT':>8}")
+        suggested = {}
+        for b in backends:
+            if b == "sift":
+                t, hits = float(utils_stitch.MIN_KEYPOINTS), n
+            else:
+                t, hits = best_threshold(scores[b], reference)
+                suggested[b] = round(t, 2)
+            ms = 1000 * timing[b] / n
+            speed = timing["sift"] / timing[b] if timing[b] else float("inf")
+            self.stdout.write(f"{b:<10} {t:>10.2f} {100 * hits / n:>7.1f}% "
+                              f"{ms:>9.2f} {speed:>7.1f}×")
+
+        self.stdout.write("\nTEXTURE_MIN = {")
+        for b, t in suggested.items():
+            key = f"{b!r}:"
+            self.stdout.write(f"    {key:<12} {t},")
+        self.stdout.write("}")
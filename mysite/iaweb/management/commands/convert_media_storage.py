@@ -0,0 +1,68 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from iaweb.models import SampleImage
+from iaweb.utils_storage import content_name, file_digest
+from iaweb.utils_thumbs import THUMB_SIZES, thumbnail_name
+
+
+class Command(BaseCommand):
+    help = ("Pasa los ficheros de SampleImage de la carpeta plana "
+            "images/<uuid>.<ext> al almacén por contenido "
+            "images/ab/cd/<blake2b>.<ext> (utils_storage), en el mismo disco "
+            "y sin copiar: enlace al nombre nuevo, actualización de la fila y "
+            "borrado del antiguo. Los ficheros repetidos quedan en uno solo. "
+            "Se puede interrumpir y relanzar.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Solo cuenta lo que haría.")
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        storage = SampleImage._meta.get_field('image').storage
+        moved = merged = missing = freed = 0
+        planned = set()         # --dry-run: destinos que ya existirían
+
+        images = SampleImage.objects.only('id', 'image').order_by('pk')
+        for simg in images.iterator(chunk_size=500):
+            old = simg.image.name
+            if not old or storage.is_content_addressed(old):
+                continue
+            path = storage.path(old)
+            try:
+                with open(path, 'rb') as fh:
+                    digest = file_digest(fh)
+            except FileNotFoundError:
+                missing += 1
+                self.stderr.write(f"Falta {old} ({simg.pk})")
+                continue
+            new = content_name(digest, os.path.splitext(old)[1].lstrip('.'))
+            size = os.path.getsize(path)
+            if new in planned or storage.exists(new):
+                merged += 1
+                freed += size
+            else:
+                moved += 1
+            if dry_run:
+                planned.add(new)
+                continue
+
+            old_thumbs = [thumbnail_name(simg.image, key) for key in THUMB_SIZES]
+            storage.link(path, new)
+            simg.image.name = new
+            for key, old_thumb in zip(THUMB_SIZES, old_thumbs):
+                if storage.exists(old_thumb):
+                    storage.link(storage.path(old_thumb),
+                                  thumbnail_name(simg.image, key))
+                    storage.delete(old_thumb)
+            # sin señales: el contenido no cambia, solo el nombre
+            SampleImage.objects.filter(pk=simg.pk).update(image=new)
+            if not SampleImage.objects.filter(image=old).exists():
+                os.remove(path)
+
+        prefix = "[dry-run] " if dry_run else ""
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix}{moved} movidos, {merged} duplicados fusionados "
+            f"({freed / 2 ** 20:.1f} MiB liberados), {missing} sin fichero."))
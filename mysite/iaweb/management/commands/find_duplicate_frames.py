@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from iaweb.models import FrameFeatures, SampleImage
+from iaweb.utils_hash import HammingIndex, phash_to_int
+from iaweb import utils_stitch
+
+
+class Command(BaseCommand):
+    help = ("Busca frames duplicados (pHash) en todas las SampleImage "
+            "usando un índice BK-tree.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--radius', type=int,
+                            default=utils_stitch.HASH_DIST_MAX,
+                            help="Distancia de Hamming máxima.")
+        parser.add_argument('--cross-sample', action='store_true',
+                            help="Solo duplicados entre muestras distintas.")
+        parser.add_argument('--compute-missing', action='store_true',
+                            help="Calcula el pHash de los frames que no lo "
+                                 "tienen en caché (decodifica la imagen).")
+
+    def handle(self, *args, **options):
+        if not utils_stitch._USE_HASH:
+            raise CommandError("imagehash no está instalado.")
+
+        radius = options['radius']
+        images = (SampleImage.objects.filter(is_mosaic=False)
+                  .select_related('features')
+                  .only('id', 'sample_id', 'image',
+                        'features__phash', 'features__image_id')
+                  .order_by('id'))
+
+        index, groups, roots, skipped = HammingIndex(), {}, {}, 0
+        for simg in images.iterator(chunk_size=2000):
+            features = getattr(simg, 'features', None)
+            phash = getattr(features, 'phash', None)
+            if phash is None and options['compute_missing']:
+                if features is None:
+                    # sin fila en caché: se calculan (y guardan) todas
+                    phash = utils_stitch.compute_frame_features(simg).phash
+                else:
+                    phash = utils_stitch.frame_phash(simg.image.path)
+                    FrameFeatures.objects.filter(image=simg).update(
+                        phash=phash)
+            if phash is None:
+                skipped += 1
+                continue
+
+            value = phash_to_int(phash)
+            key = (simg.id, simg.sample_id)
+            matches = [(dist, other) for other, dist
+                       in index.query(value, radius)
+                       if not (options['cross_sample']
+                               and other[1] == simg.sample_id)]
+            if matches:
+                # se une al grupo del frame anterior más parecido
+                dist, other = min(matches)
+                first = roots.setdefault(other, other)
+                roots[key] = first
+                groups.setdefault(first, [first]).append((key, dist))
+            index.add(value, key)
+
+        for (image_id, sample_id), *dups in groups.values():
+            self.stdout.write(f"{image_id} (sample {sample_id})")
+            for (dup_id, dup_sample), dist in dups:
+                self.stdout.write(f"    ≈ {dup_id} (sample {dup_sample}, "
+                                  f"d={dist})")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{len(index)} frames indexados, {len(groups)} grupos de "
+            f"duplicados, {skipped} sin pHash."))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from iaweb.utils_storage import CAS_GRACE_S, collect_garbage
+
+
+class Command(BaseCommand):
+    help = ("Borra del almacén por contenido (utils_storage) los originales "
+            "que ya no usa ninguna SampleImage, con sus miniaturas, y los "
+            "temporales de subidas cortadas. Solo los que llevan --grace "
+            "horas sin usarse: una subida en curso puede estar reutilizando "
+            "un fichero. Se puede lanzar con el servidor en marcha (cron).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace', type=float, default=CAS_GRACE_S / 3600,
+                            help="Horas sin usarse antes de borrar.")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Solo cuenta lo que borraría.")
+
+    def handle(self, *args, **options):
+        removed, freed = collect_garbage(grace=options['grace'] * 3600,
+                                         dry_run=options['dry_run'])
+        prefix = "[dry-run] " if options['dry_run'] else ""
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix}{removed} ficheros borrados "
+            f"({freed / 2 ** 20:.1f} MiB liberados)."))
@@ -0,0 +1,95 @@
+import asyncio
+import statistics
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = ("Prueba de carga con clientes lentos (como los microscopios): "
+            "abre N conexiones a la vez contra una URL que suba una imagen "
+            "en trozos espaciados y mide cuántas termina el servidor y en "
+            "cuánto tiempo. Para comparar WSGI y ASGI, lánzalo contra cada "
+            "servidor, p. ej. 'gunicorn mysite.wsgi' con --url "
+            "…/api/v1/image/?sample=<id> y 'uvicorn mysite.asgi:application' "
+            "con --url …/api/v1/async/image/?sample=<id>.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', required=True,
+                            help="Endpoint (http://host:puerto/ruta?query).")
+        parser.add_argument('--file', default=None,
+                            help="Cuerpo a enviar (POST); si no, GET.")
+        parser.add_argument('--concurrency', type=int, action='append',
+                            default=[],
+                            help="Conexiones simultáneas (repetible).")
+        parser.add_argument('--chunks', type=int, default=10,
+                            help="Trozos en que se parte el cuerpo.")
+        parser.add_argument('--delay', type=float, default=0.2,
+                            help="Pausa entre trozos (s): cliente lento.")
+        parser.add_argument('--timeout', type=float, default=60.0,
+                            help="Tiempo máximo por petición (s).")
+
+    async def _request(self, url, body, chunks, delay):
+        parts = urlsplit(url)
+        path = parts.path + (f"?{parts.query}" if parts.query else "")
+        reader, writer = await asyncio.open_connection(
+            parts.hostname, parts.port or 80)
+        try:
+            method = "POST" if body is not None else "GET"
+            head = [f"{method} {path} HTTP/1.1", f"Host: {parts.netloc}",
+                    "Connection: close"]
+            if body is not None:
+                head += ["Content-Type: application/octet-stream",
+                         f"Content-Length: {len(body)}"]
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode())
+            if body:
+                step = -(-len(body) // chunks)
+                for i in range(0, len(body), step):
+                    writer.write(body[i:i + step])
+                    await writer.drain()
+                    await asyncio.sleep(delay)
+            status_line = await reader.readline()
+            await reader.read()
+            return int(status_line.split()[1])
+        finally:
+            writer.close()
+
+    async def _timed(self, url, body, options):
+        t0 = time.perf_counter()
+        try:
+            code = await asyncio.wait_for(
+                self._request(url, body, options['chunks'], options['delay']),
+                options['timeout'])
+        except (OSError, asyncio.TimeoutError, IndexError, ValueError):
+            code = None
+        return code, time.perf_counter() - t0
+
+    async def _round(self, url, body, n, options):
+        t0 = time.perf_counter()
+        results = await asyncio.gather(
+            *(self._timed(url, body, options) for _ in range(n)))
+        return results, time.perf_counter() - t0
+
+    def handle(self, *args, **options):
+        if not options['url'].startswith('http://'):
+            raise CommandError("Solo URLs http://.")
+        body = None
+        if options['file']:
+            with open(options['file'], 'rb') as fh:
+                body = fh.read()
+        levels = options['concurrency'] or [10, 50, 100, 200]
+
+        self.stdout.write(f"{'conex.':>6} {'ok':>5} {'error':>5} "
+                          f"{'p50 (s)':>8} {'p95 (s)':>8} {'total (s)':>9} "
+                          f"{'ok/s':>7}")
+        for n in levels:
+            results, wall = asyncio.run(self._round(options['url'], body,
+                                                    n, options))
+            ok = sorted(t for code, t in results
+                        if code is not None and code < 400)
+            p50 = statistics.median(ok) if ok else 0.0
+            p95 = ok[int(len(ok) * 0.95) - 1] if ok else 0.0
+            self.stdout.write(f"{n:>6} {len(ok):>5} {n - len(ok):>5} "
+                              f"{p50:>8.2f} {p95:>8.2f} {wall:>9.2f} "
+                              f"{len(ok) / wall:>7.1f}")
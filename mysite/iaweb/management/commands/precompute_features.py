@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from iaweb.models import SampleImage
+from iaweb import utils_stitch
+
+
+class Command(BaseCommand):
+    help = ("Calcula las métricas de calidad (FrameFeatures) de las "
+            "sub-imágenes que aún no las tienen o están desfasadas.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sample', help="Solo esta muestra (id).")
+        parser.add_argument('--all', action='store_true',
+                            help="Recalcula también las que ya tienen.")
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Procesos para el cálculo.")
+
+    def handle(self, *args, **options):
+        params = utils_stitch._feature_params()
+        images = SampleImage.objects.filter(is_mosaic=False)
+        if options['sample']:
+            images = images.filter(sample_id=options['sample'])
+        if not options['all']:
+            images = images.filter(Q(features__isnull=True)
+                                   | ~Q(features__params=params)
+                                   | Q(features__texture_score__isnull=True))
+        images = list(images.order_by('id'))
+
+        jobs = [(simg.image.path, None) for simg in images]
+        results = utils_stitch._analyze_frames(
+            jobs, options['workers'], keep_full=False, complete=True)
+        done = 0
+        for simg, m in zip(images, results):
+            utils_stitch._store_metrics(simg, m, params)
+            done += 1
+            if done % 100 == 0:
+                self.stdout.write(f"{done}/{len(images)}")
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Métricas calculadas para {done} imágenes."))
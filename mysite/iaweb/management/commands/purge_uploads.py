@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from iaweb.utils_upload import purge_stale_uploads
+
+
+class Command(BaseCommand):
+    help = ("Borra las subidas reanudables abandonadas (sesión abierta sin "
+            "actividad) y sus ficheros parciales.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=float, default=72,
+                            help="Horas sin actividad para darla por "
+                                 "abandonada.")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options['hours'])
+        n = purge_stale_uploads(cutoff)
+        self.stdout.write(self.style.SUCCESS(f"Borradas {n} subidas."))
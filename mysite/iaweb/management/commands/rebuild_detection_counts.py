@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from iaweb.models import Sample
+from iaweb.utils_detections import (build_report, rebuild_detection_counts,
+                                    sample_detection_totals)
+
+
+class Command(BaseCommand):
+    help = ("Recalcula los contadores de detecciones (DetectionCount) desde "
+            "detection_results, agregando en la base de datos.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sample', action='append', default=[],
+                            help="Limita a estas muestras (repetible).")
+        parser.add_argument('--reports', action='store_true',
+                            help="Regenera también el informe de las "
+                                 "muestras no disponibles.")
+
+    def handle(self, *args, **options):
+        samples = Sample.objects.all()
+        if options['sample']:
+            samples = samples.filter(pk__in=options['sample'])
+
+        fixed = 0
+        for sample_id, available in samples.values_list('id', 'available'):
+            before = sample_detection_totals(sample_id)
+            after = rebuild_detection_counts(sample_id)
+            # los contadores a 0 equivalen a no tener fila
+            if +before != +after:
+                fixed += 1
+                self.stdout.write(f"{sample_id}: {dict(+before)} → "
+                                  f"{dict(+after)}")
+            if options['reports'] and not available:
+                build_report(sample_id)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Contadores revisados; {fixed} muestras corregidas."))
@@ -0,0 +1,64 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from iaweb import utils_detect
+
+
+class Command(BaseCommand):
+    help = ("Ejecuta el detector por lotes sobre las sub-imágenes que aún "
+            "no tienen detection_results.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', default=None,
+                            help="Modelo ONNX (por defecto DETECT_MODEL).")
+        parser.add_argument('--backend', choices=utils_detect.DETECT_BACKENDS,
+                            default=None)
+        parser.add_argument('--threads', type=int, default=None,
+                            help="Hilos de inferencia.")
+        parser.add_argument('--batch', type=int, default=None,
+                            help="Frames por lote.")
+        parser.add_argument('--poll', type=float, default=5.0,
+                            help="Segundos de espera con la cola vacía.")
+        parser.add_argument('--once', action='store_true',
+                            help="Vacía la cola y termina.")
+        parser.add_argument('--mosaics', action='store_true',
+                            help="Procesa también los mosaicos, por "
+                                 "teselas a resolución completa.")
+
+    def handle(self, *args, **options):
+        model = options['model'] or utils_detect.DETECT_MODEL
+        if not os.path.exists(model):
+            raise CommandError(f"No existe el modelo {model}.")
+        detector = utils_detect.Detector(model, options['backend'],
+                                         options['threads'])
+        batch = options['batch'] or utils_detect.DETECT_BATCH
+        self.stdout.write(f"Detector {type(detector.backend).__name__}, "
+                          f"lotes de {batch}.")
+
+        def report(n, dt):
+            self.stdout.write(f"  {n} frames en {dt:.2f}s "
+                              f"({n / dt:.1f} fps)")
+
+        while True:
+            # de pocos lotes en pocos: lo nuevo entra en la siguiente vuelta
+            images = list(utils_detect.pending_images()[:batch * 4])
+            mosaic = (utils_detect.pending_mosaics().first()
+                      if options['mosaics'] else None)
+            if mosaic is not None:
+                t0 = time.perf_counter()
+                dets = utils_detect.detect_mosaic(detector, mosaic, batch)
+                self.stdout.write(f"Mosaico {mosaic.pk}: {len(dets)} "
+                                  f"detecciones en "
+                                  f"{time.perf_counter() - t0:.1f}s")
+            if not images:
+                if mosaic is not None:
+                    continue
+                if options['once']:
+                    return
+                time.sleep(options['poll'])
+                continue
+            n, dt = utils_detect.run_batches(detector, images, batch, report)
+            self.stdout.write(self.style.SUCCESS(
+                f"{n} frames, {n / dt:.1f} fps de media."))
@@ -0,0 +1,48 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from iaweb.utils_jobs import claim_next_job, requeue_stale_jobs, run_job
+
+
+class Command(BaseCommand):
+    help = "Procesa la cola de trabajos de stitching (StitchJob)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help="Procesos para el filtrado de frames.")
+        parser.add_argument('--poll', type=float, default=2.0,
+                            help="Segundos de espera con la cola vacía.")
+        parser.add_argument('--once', action='store_true',
+                            help="Vacía la cola y termina.")
+        parser.add_argument('--requeue', action='store_true',
+                            help="Al arrancar, reencola ya todos los "
+                                 "trabajos 'running' (sin esperar a que "
+                                 "caduque su latido): solo si no queda "
+                                 "ningún otro worker vivo.")
+
+    def handle(self, *args, **options):
+        if options['requeue']:
+            n = requeue_stale_jobs(lease=0)
+            self.stdout.write(f"Reencolados {n} trabajos.")
+
+        while True:
+            job = claim_next_job()
+            if job is None:
+                if options['once']:
+                    return
+                # trabajos de workers caídos (latido caducado)
+                n = requeue_stale_jobs()
+                if n:
+                    self.stdout.write(f"Reencolados {n} trabajos huérfanos.")
+                    continue
+                time.sleep(options['poll'])
+                continue
+
+            self.stdout.write(f"→ {job} (intento {job.attempts + 1})")
+            job = run_job(job, options['workers'])
+            style = (self.style.SUCCESS if job.status == job.DONE
+                     else self.style.ERROR)
+            self.stdout.write(style(
+                f"  {job.get_status_display()}: "
+                f"{job.frames_kept}/{job.frames_total} frames"))
@@ -0,0 +1,38 @@
+# Generated by Django 5.0.7 on 2026-10-16 22:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iaweb', '0002_sampleimagevisualizer_sampleimage_is_mosaic'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StitchJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('circular', 'Circular'), ('cropped', 'Cropped')], max_length=10)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('max_attempts', models.PositiveIntegerField(default=3)),
+                ('frames_total', models.PositiveIntegerField(default=0)),
+                ('frames_scanned', models.PositiveIntegerField(default=0)),
+                ('frames_kept', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('date_created', models.DateTimeField(auto_now_add=True, verbose_name='Date Created')),
+                ('date_started', models.DateTimeField(blank=True, null=True, verbose_name='Date Started')),
+                ('date_finished', models.DateTimeField(blank=True, null=True, verbose_name='Date Finished')),
+                ('mosaic', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='iaweb.sampleimage')),
+                ('sample', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stitch_jobs', to='iaweb.sample', verbose_name='Sample')),
+            ],
+            options={
+                'verbose_name': 'Stitch Job',
+                'verbose_name_plural': 'Stitch Jobs',
+                'ordering': ['-date_created'],
+            },
+        ),
+    ]
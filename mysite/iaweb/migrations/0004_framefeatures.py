@@ -0,0 +1,37 @@
+# Generated by Django 5.0.7 on 2026-10-16 22:58
+
+import django.db.models.deletion
+import iaweb.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iaweb', '0003_stitchjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FrameFeatures',
+            fields=[
+                ('image', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='features', serialize=False, to='iaweb.sampleimage')),
+                ('checksum', models.CharField(max_length=64)),
+                ('params', models.CharField(max_length=64)),
+                ('box_x0', models.IntegerField()),
+                ('box_y0', models.IntegerField()),
+                ('box_x1', models.IntegerField()),
+                ('box_y1', models.IntegerField()),
+                ('black_ratio', models.FloatField()),
+                ('white_ratio', models.FloatField()),
+                ('keypoints', models.IntegerField(blank=True, null=True)),
+                ('phash', models.CharField(blank=True, max_length=16, null=True)),
+                ('thumbnail', models.ImageField(blank=True, null=True, upload_to=iaweb.models.FrameFeatures.frame_features_upload_to)),
+                ('date_computed', models.DateTimeField(auto_now=True, verbose_name='Date Computed')),
+            ],
+            options={
+                'verbose_name': 'Frame Features',
+                'verbose_name_plural': 'Frame Features',
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.0.7 on 2026-10-16 23:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iaweb', '0004_framefeatures'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='framefeatures',
+            name='sharpness',
+            field=models.FloatField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='framefeatures',
+            name='black_ratio',
+            field=models.FloatField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='framefeatures',
+            name='keypoints',
+            field=models.IntegerField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='framefeatures',
+            name='white_ratio',
+            field=models.FloatField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.7 on 2026-10-16 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iaweb', '0005_framefeatures_sharpness_indexes'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='framefeatures',
+            old_name='keypoints',
+            new_name='texture_score',
+        ),
+        migrations.AlterField(
+            model_name='framefeatures',
+            name='texture_score',
+            field=models.FloatField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.0.7 on 2026-10-16 23:09
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iaweb', '0006_framefeatures_texture_score'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('filename', models.CharField(blank=True, default='', max_length=255)),
+                ('size', models.PositiveBigIntegerField()),
+                ('checksum', models.CharField(max_length=64)),
+                ('offset', models.PositiveBigIntegerField(default=0)),
+                ('status', models.CharField(choices=[('open', 'Open'), ('complete', 'Complete')], default='open', max_length=10)),
+                ('date_created', models.DateTimeField(auto_now_add=True, verbose_name='Date Created')),
+                ('date_updated', models.DateTimeField(auto_now=True, verbose_name='Date Updated')),
+                ('image', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='iaweb.sampleimage')),
+                ('sample', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to='iaweb.sample', verbose_name='Sample')),
+            ],
+            options={
+                'verbose_name': 'Upload Session',
+                'verbose_name_plural': 'Upload Sessions',
+                'ordering': ['-date_created'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='uploadsession',
+            constraint=models.UniqueConstraint(fields=('sample', 'checksum'), name='unique_upload_per_sample'),
+        ),
+    ]
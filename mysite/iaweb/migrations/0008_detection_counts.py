@@ -0,0 +1,79 @@
+# Generated by Django 5.0.7 on 2026-10-16 23:12
+
+from collections import Counter
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def dedupe_reports(apps, schema_editor):
+    """Deja solo el informe más reciente de cada muestra."""
+    DiagnosisReport = apps.get_model('iaweb', 'DiagnosisReport')
+    seen = set()
+    stale = []
+    for pk, sample_id in (DiagnosisReport.objects
+                          .order_by('sample_id', '-date_published')
+                          .values_list('pk', 'sample_id')):
+        if sample_id in seen:
+            stale.append(pk)
+        seen.add(sample_id)
+    DiagnosisReport.objects.filter(pk__in=stale).delete()
+
+
+def backfill_counts(apps, schema_editor):
+    SampleImage = apps.get_model('iaweb', 'SampleImage')
+    DetectionCount = apps.get_model('iaweb', 'DetectionCount')
+    totals = Counter()
+    images = (SampleImage.objects.exclude(detection_results=None)
+              .only('id', 'sample_id', 'detection_results'))
+    for simg in images.iterator():
+        counts = Counter(d['name'] for d in simg.detection_results or [])
+        SampleImage.objects.filter(pk=simg.pk).update(
+            detection_counts=dict(counts))
+        for label, n in counts.items():
+            totals[simg.sample_id, label] += n
+    DetectionCount.objects.bulk_create(
+        DetectionCount(sample_id=sample_id, label=label, count=n)
+        for (sample_id, label), n in totals.items())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iaweb', '0007_uploadsession'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DetectionCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('label', models.CharField(max_length=50)),
+                ('count', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name': 'Detection Count',
+                'verbose_name_plural': 'Detection Counts',
+            },
+        ),
+        migrations.AddField(
+            model_name='sampleimage',
+            name='detection_counts',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='detectioncount',
+            name='sample',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='detection_totals', to='iaweb.sample', verbose_name='Sample'),
+        ),
+        migrations.RunPython(dedupe_reports, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='diagnosisreport',
+            constraint=models.UniqueConstraint(fields=('sample',), name='unique_report_per_sample'),
+        ),
+        migrations.AddConstraint(
+            model_name='detectioncount',
+            constraint=models.UniqueConstraint(fields=('sample', 'label'), name='unique_detection_count'),
+        ),
+        migrations.RunPython(backfill_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-16 23:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iaweb', '0008_detection_counts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sampleimage',
+            name='mosaic_layout',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.0.7 on 2026-10-16 23:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iaweb', '0009_sampleimage_mosaic_layout'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='sampleimage',
+            index=models.Index(fields=['sample', 'is_mosaic', 'id'], name='sampleimage_sample_mosaic_id'),
+        ),
+        migrations.AddIndex(
+            model_name='sampleimage',
+            index=models.Index(fields=['sample', 'date_published'], name='sampleimage_sample_date'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.0.7 on 2026-10-16 23:25
+
+import iaweb.models
+import iaweb.utils_storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iaweb', '0010_sampleimage_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='sampleimage',
+            name='image',
+            field=models.ImageField(storage=iaweb.utils_storage.sample_image_storage, upload_to=iaweb.models.SampleImage.sample_image_upload_to),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.7 on 2026-10-16 23:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iaweb', '0011_sampleimage_content_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stitchjob',
+            name='heartbeat',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Heartbeat'),
+        ),
+        migrations.AddField(
+            model_name='stitchjob',
+            name='retry_after',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Retry After'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.7 on 2026-10-16 23:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iaweb', '0012_stitchjob_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='framefeatures',
+            name='file_mtime',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='framefeatures',
+            name='file_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
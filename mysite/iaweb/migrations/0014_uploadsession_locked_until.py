@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-16 23:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iaweb', '0013_framefeatures_file_stat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='locked_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
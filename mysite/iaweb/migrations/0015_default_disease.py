@@ -0,0 +1,31 @@
+# Generated by Django 5.0.7 on 2026-10-16 23:58
+
+from django.core.management.color import no_style
+from django.db import migrations
+
+
+def create_default_disease(apps, schema_editor):
+    """``DiagnosisReport.diseases`` apunta por defecto a la enfermedad 1:
+    debe existir también en una base de datos recién creada."""
+    Disease = apps.get_model('iaweb', 'Disease')
+    if Disease.objects.filter(pk=1).exists() \
+            or Disease.objects.filter(name='Malaria').exists():
+        return
+    Disease.objects.create(pk=1, name='Malaria')
+    # pk explícita: la secuencia (PostgreSQL) debe seguir por detrás
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(), [Disease]):
+            cursor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iaweb', '0014_uploadsession_locked_until'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_default_disease,
+                             migrations.RunPython.noop),
+    ]
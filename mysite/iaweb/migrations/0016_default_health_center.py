@@ -0,0 +1,34 @@
+# Generated by Django 5.0.7 on 2026-10-17 09:12
+
+from django.core.management.color import no_style
+from django.db import migrations
+from django.utils import timezone
+
+
+def create_default_health_center(apps, schema_editor):
+    """``Sample.health_center`` apunta por defecto al centro 1 (el de la
+    BD del repositorio): debe existir también en una BD recién creada."""
+    HealthCenter = apps.get_model('iaweb', 'HealthCenter')
+    if HealthCenter.objects.filter(pk=1).exists():
+        return
+    HealthCenter.objects.create(pk=1, name='UPC', city='Barcelona',
+                                country='Spain',
+                                date_published=timezone.now())
+    # pk explícita: la secuencia (PostgreSQL) debe seguir por detrás
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        for sql in connection.ops.sequence_reset_sql(no_style(),
+                                                     [HealthCenter]):
+            cursor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('iaweb', '0015_default_disease'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_default_health_center,
+                             migrations.RunPython.noop),
+    ]
@@ -1,5 +1,6 @@
 import uuid
 from django.db import models
+from .utils_storage import sample_image_storage
 
 
 # ════════════════════════════════════════════════════════════════
@@ -92,7 +93,9 @@ class SampleImage(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     sample = models.ForeignKey(Sample, related_name='images',
                                on_delete=models.CASCADE, verbose_name="Sample")
-    image = models.ImageField(upload_to=sample_image_upload_to)
+    # nombre final = hash del contenido, sin duplicados (utils_storage)
+    image = models.ImageField(upload_to=sample_image_upload_to,
+                              storage=sample_image_storage)
     date_published = models.DateTimeField("Date Published", auto_now_add=True)
     detection_results = models.JSONField(null=True, blank=True)
     detected_image = models.ImageField(
@@ -100,6 +103,10 @@ class SampleImage(models.Model):
 
     # ─── NUEVO ───
     is_mosaic = models.BooleanField(default=False, editable=False)
+    # detecciones por clase ya sumadas a DetectionCount (utils_detections)
+    detection_counts = models.JSONField(null=True, blank=True, editable=False)
+    # mosaicos: qué frame hay en cada celda (utils_stitch._grid_layout)
+    mosaic_layout = models.JSONField(null=True, blank=True, editable=False)
 
     def __str__(self):
         return f"Images for {self.sample.id}"
@@ -108,6 +115,14 @@ class SampleImage(models.Model):
         verbose_name = "Image"
         verbose_name_plural = "Images"
         ordering = ['-date_published']
+        indexes = [
+            # frames de una muestra por id (stitching, visualizer)
+            models.Index(fields=['sample', 'is_mosaic', 'id'],
+                         name='sampleimage_sample_mosaic_id'),
+            # imágenes de una muestra en el orden por defecto
+            models.Index(fields=['sample', 'date_published'],
+                         name='sampleimage_sample_date'),
+        ]
 
 
 # ════════════════════════════════════════════════════════════════
@@ -122,6 +137,102 @@ class SampleImageVisualizer(SampleImage):
         verbose_name_plural = "Visualizer"
 
 
+# ════════════════════════════════════════════════════════════════
+#  CACHÉ DE MÉTRICAS DE FILTRADO (por sub-imagen)
+# ════════════════════════════════════════════════════════════════
+class FrameFeatures(models.Model):
+    """Resultado de los filtros de ``utils_stitch`` para una sub-imagen.
+
+    Vale mientras coincidan ``checksum`` (contenido del fichero) y
+    ``params`` (parámetros que cambian las métricas); los umbrales no
+    forman parte de la clave, así que re-stitchear con umbrales iguales o
+    más estrictos no vuelve a decodificar los frames descartados.
+    ``file_size``/``file_mtime`` son el ``stat`` del fichero cuando se
+    calculó el checksum: si no han cambiado, ni se relee ni se rehashea.
+    """
+
+    def frame_features_upload_to(instance, filename):
+        return f"thumbs/features/{instance.image_id}.jpg"
+
+    image = models.OneToOneField(SampleImage, primary_key=True,
+                                 related_name='features',
+                                 on_delete=models.CASCADE)
+    checksum = models.CharField(max_length=64)
+    file_size = models.BigIntegerField(null=True, blank=True)
+    file_mtime = models.BigIntegerField(null=True, blank=True)   # ns
+    params = models.CharField(max_length=64)
+    box_x0 = models.IntegerField()
+    box_y0 = models.IntegerField()
+    box_x1 = models.IntegerField()
+    box_y1 = models.IntegerField()
+    black_ratio = models.FloatField(db_index=True)
+    white_ratio = models.FloatField(db_index=True)
+    texture_score = models.FloatField(null=True, blank=True, db_index=True)
+    sharpness = models.FloatField(null=True, blank=True, db_index=True)
+    phash = models.CharField(max_length=16, null=True, blank=True)
+    thumbnail = models.ImageField(upload_to=frame_features_upload_to,
+                                  null=True, blank=True)
+    date_computed = models.DateTimeField("Date Computed", auto_now=True)
+
+    @property
+    def box(self):
+        return self.box_x0, self.box_y0, self.box_x1, self.box_y1
+
+    def __str__(self):
+        return f"Features for {self.image_id}"
+
+    class Meta:
+        verbose_name = "Frame Features"
+        verbose_name_plural = "Frame Features"
+
+
+# ════════════════════════════════════════════════════════════════
+#  SUBIDA REANUDABLE (por trozos)
+# ════════════════════════════════════════════════════════════════
+class UploadSession(models.Model):
+    """Subida de una sub-imagen por trozos (ver ``utils_upload``).
+
+    ``checksum`` (BLAKE2b-256 del fichero completo) identifica la subida:
+    un reintento con el mismo contenido reanuda la sesión existente en
+    lugar de crear otra fila u otro fichero.
+    """
+    OPEN = 'open'
+    COMPLETE = 'complete'
+    STATUS_CHOICES = [
+        (OPEN, 'Open'),
+        (COMPLETE, 'Complete'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    sample = models.ForeignKey(Sample, related_name='upload_sessions',
+                               on_delete=models.CASCADE, verbose_name="Sample")
+    filename = models.CharField(max_length=255, blank=True, default='')
+    size = models.PositiveBigIntegerField()
+    checksum = models.CharField(max_length=64)
+    offset = models.PositiveBigIntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=OPEN)
+    image = models.ForeignKey(SampleImage, null=True, blank=True,
+                              on_delete=models.SET_NULL, related_name='+')
+    # un solo trozo escribiendo a la vez (reserva con caducidad: un
+    # proceso caído a medias no bloquea la sesión para siempre)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    date_created = models.DateTimeField("Date Created", auto_now_add=True)
+    date_updated = models.DateTimeField("Date Updated", auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename or self.id} ({self.offset}/{self.size})"
+
+    class Meta:
+        verbose_name = "Upload Session"
+        verbose_name_plural = "Upload Sessions"
+        ordering = ['-date_created']
+        constraints = [
+            models.UniqueConstraint(fields=['sample', 'checksum'],
+                                    name='unique_upload_per_sample'),
+        ]
+
+
 # ════════════════════════════════════════════════════════════════
 #  ENFERMEDAD
 # ════════════════════════════════════════════════════════════════
@@ -168,3 +279,84 @@ class DiagnosisReport(models.Model):
         verbose_name = "Diagnosis Report"
         verbose_name_plural = "Diagnosis Reports"
         ordering = ['-date_published']
+        constraints = [
+            models.UniqueConstraint(fields=['sample'],
+                                    name='unique_report_per_sample'),
+        ]
+
+
+# ════════════════════════════════════════════════════════════════
+#  CONTADORES DE DETECCIONES (por muestra y clase)
+# ════════════════════════════════════════════════════════════════
+class DetectionCount(models.Model):
+    """Suma de ``detection_results`` de las imágenes de una muestra para
+    una clase; se mantiene al guardar/borrar cada ``SampleImage``."""
+    sample = models.ForeignKey(Sample, related_name='detection_totals',
+                               on_delete=models.CASCADE, verbose_name="Sample")
+    label = models.CharField(max_length=50)
+    count = models.IntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.label}: {self.count}"
+
+    class Meta:
+        verbose_name = "Detection Count"
+        verbose_name_plural = "Detection Counts"
+        constraints = [
+            models.UniqueConstraint(fields=['sample', 'label'],
+                                    name='unique_detection_count'),
+        ]
+
+
+# ════════════════════════════════════════════════════════════════
+#  TRABAJO DE STITCHING (cola en base de datos)
+# ════════════════════════════════════════════════════════════════
+class StitchJob(models.Model):
+    CIRCULAR = 'circular'
+    CROPPED = 'cropped'
+    KIND_CHOICES = [
+        (CIRCULAR, 'Circular'),
+        (CROPPED, 'Cropped'),
+    ]
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    sample = models.ForeignKey(Sample, related_name='stitch_jobs',
+                               on_delete=models.CASCADE, verbose_name="Sample")
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    frames_total = models.PositiveIntegerField(default=0)
+    frames_scanned = models.PositiveIntegerField(default=0)
+    frames_kept = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    mosaic = models.ForeignKey(SampleImage, null=True, blank=True,
+                               on_delete=models.SET_NULL, related_name='+')
+    date_created = models.DateTimeField("Date Created", auto_now_add=True)
+    date_started = models.DateTimeField("Date Started", null=True, blank=True)
+    date_finished = models.DateTimeField("Date Finished",
+                                         null=True, blank=True)
+    # lo renueva el worker mientras trabaja; si caduca, el trabajo vuelve
+    # a la cola (utils_jobs.requeue_stale_jobs)
+    heartbeat = models.DateTimeField("Heartbeat", null=True, blank=True)
+    # reintento con espera creciente tras un fallo
+    retry_after = models.DateTimeField("Retry After", null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.get_kind_display()} - {self.sample_id}"
+
+    class Meta:
+        verbose_name = "Stitch Job"
+        verbose_name_plural = "Stitch Jobs"
+        ordering = ['-date_created']
@@ -1,18 +1,22 @@
 # serializers.py
 
+from django.core.exceptions import ValidationError
 from rest_framework import serializers
-from .models import DiagnosisReport, SampleImage, Sample
-import base64
-from django.core.files.base import ContentFile
+from .models import DiagnosisReport, SampleImage, Sample, UploadSession
+from .utils_upload import base64_upload
 
 
 class Base64ImageField(serializers.ImageField):
+    """Acepta un fichero (multipart o cuerpo binario, ver
+    ``utils_upload.BinaryImageParser``) o, por compatibilidad, una
+    data-URL en base64."""
+
     def to_internal_value(self, data):
         if isinstance(data, str) and data.startswith('data:image'):
-            # Parse the base64 image string
-            format, imgstr = data.split(';base64,')
-            ext = format.split('/')[-1]
-            data = ContentFile(base64.b64decode(imgstr), name='temp.' + ext)
+            try:
+                data = base64_upload(data)
+            except ValidationError as exc:
+                raise serializers.ValidationError(exc.messages)
         return super().to_internal_value(data)
 
 
@@ -24,8 +28,34 @@ class SampleImageSerializer(serializers.ModelSerializer):
         model = SampleImage
         fields = ['id', 'sample', 'image', 'date_published']
 
+    def create(self, validated_data):
+        image = validated_data['image']
+        try:
+            return super().create(validated_data)
+        finally:
+            # los temporales del base64 no los cierra la petición
+            image.close()
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'sample', 'filename', 'size', 'checksum', 'offset',
+                  'status', 'image']
+        read_only_fields = ['offset', 'status', 'image']
+        # el duplicado (sample, checksum) no es un error: se reanuda
+        validators = []
+
 
 class SampleSerializer(serializers.ModelSerializer):
+    """``expand_images=False`` quita la lista de ids de ``images`` (y con
+    ella la consulta que la rellena)."""
+
+    def __init__(self, *args, expand_images=True, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not expand_images:
+            self.fields.pop('images')
+
     class Meta:
         model = Sample
         fields = ['id', 'patient', 'sample_type', 'date_published',
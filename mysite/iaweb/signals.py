@@ -1,27 +1,92 @@
-from django.db.models.signals import post_save
+from django.db.models import QuerySet
+from django.db.models.signals import (post_delete, post_save, pre_delete,
+                                      pre_save)
 from django.dispatch import receiver
-from .models import DiagnosisReport, SampleImage, Sample
-# IA DESACTIVADA ────────────────────────────────────────────────
-# de momento no importamos ni creamos el detector YOLO
-# from .utils import YOLOv5Detector
+from .models import SampleImage, Sample
+# IA ─────────────────────────────────────────────────────────────
+# la detección ya no se hace aquí: ``manage.py run_detection_worker``
+# procesa por lotes las imágenes sin detection_results (utils_detect)
 from django.core.files import File
 import os
 import shutil
-from collections import Counter
-from django.utils import timezone
-from .utils import calculate_parasite_density
+from .utils_cache import bump_sample_list
+from .utils_detections import (apply_detection_counts, build_report,
+                               remove_detection_counts)
+from .utils_ingest import schedule_ingest
 
-# IA DESACTIVADA ────────────────────────────────────────────────
-# yolo_detector = YOLOv5Detector()
+
+# -----------------------------------------------------------------
+# 1. Al llegar una nueva imagen: encolamos el cálculo de métricas de
+#    calidad (ver utils_ingest); la IA la recoge el worker de detección
+# -----------------------------------------------------------------
+@receiver(post_save, sender=SampleImage)
+def run_yolov5_detection(sender, instance, created, raw=False, **kwargs):
+    if not created or raw or instance.is_mosaic:
+        return
+    schedule_ingest(instance.id)
+
+
+# -----------------------------------------------------------------
+# 1b. Invalidan la caché del listado api/v1/sample/ (ver utils_cache):
+#     cualquier cambio en una muestra y las altas / bajas de imágenes.
+#     El listado solo lleva los ids de las imágenes, así que guardar
+#     detecciones o métricas no lo invalida.
+# -----------------------------------------------------------------
+@receiver(post_save, sender=Sample)
+@receiver(post_delete, sender=Sample)
+@receiver(post_delete, sender=SampleImage)
+def invalidate_sample_list(sender, raw=False, **kwargs):
+    if not raw:
+        bump_sample_list()
+
+
+@receiver(post_save, sender=SampleImage)
+def invalidate_sample_list_on_new_image(sender, created, raw=False, **kwargs):
+    if created and not raw:
+        bump_sample_list()
 
 
 # -----------------------------------------------------------------
-# 1. Al llegar una nueva imagen: NO ejecutamos IA ni recortamos
+# 1c. Contadores de detecciones por muestra: solo la diferencia con lo
+#     que la imagen ya había aportado (ver utils_detections)
 # -----------------------------------------------------------------
+@receiver(pre_save, sender=SampleImage)
+def remember_detection_counts(sender, instance, raw=False,
+                              update_fields=None, **kwargs):
+    # lo aportado se lee de la BD: la instancia puede estar desfasada
+    instance._applied_counts = None
+    if raw or instance._state.adding:
+        return
+    if update_fields is not None and 'detection_results' not in update_fields:
+        return
+    instance._applied_counts = (SampleImage.objects.filter(pk=instance.pk)
+                                .values_list('detection_counts', flat=True)
+                                .first())
+
+
 @receiver(post_save, sender=SampleImage)
-def run_yolov5_detection(sender, instance, created, **kwargs):
-    # Saltamos cualquier inferencia; la imagen queda tal cual
-    return
+def update_detection_counts(sender, instance, raw=False,
+                            update_fields=None, **kwargs):
+    if raw:
+        return
+    if update_fields is not None and 'detection_results' not in update_fields:
+        return
+    apply_detection_counts(instance, getattr(instance, '_applied_counts', None))
+
+
+@receiver(pre_delete, sender=SampleImage)
+def discard_detection_counts(sender, instance, origin=None, **kwargs):
+    # se envía por cada imagen: lo caro se hace una vez por borrado
+    if isinstance(origin, Sample) or getattr(origin, 'model', None) is Sample:
+        return      # se va la muestra entera y sus contadores con ella
+    if isinstance(origin, QuerySet):
+        if not getattr(origin, '_detection_counts_removed', False):
+            origin._detection_counts_removed = True
+            remove_detection_counts(origin)
+        return
+    # una sola imagen: lo aportado se lee de la BD, no de la instancia
+    # (puede estar desfasada)
+    remove_detection_counts(SampleImage.objects.filter(pk=instance.pk))
 
 
 # -----------------------------------------------------------------
@@ -41,35 +106,6 @@ def run_diagnosis_report(sample_id):
 
 
 def get_results(sample_id):
-    sample_images = SampleImage.objects.filter(sample=sample_id)
-
-    detection_counter = Counter()
-    total_of_images = len(sample_images)
-
-    for sample_image in sample_images:
-        # Protección: sin IA los resultados vienen vacíos o None
-        if not sample_image.detection_results:
-            continue
-        for detection in sample_image.detection_results:
-            detection_counter[detection['name']] += 1
-
-    leukocytes = detection_counter['leukocytes']
-    malaria_trophozoite = detection_counter['malaria_trophozoite']
-    malaria_mature_trophozoite = detection_counter['malaria_mature_trophozoite']
-    total_parasites = malaria_trophozoite + malaria_mature_trophozoite
-
-    parasitemia_level = calculate_parasite_density(total_parasites, leukocytes)
-    diagnosis_result = total_parasites > 0
-
-    report = DiagnosisReport(
-        sample_id=sample_id,
-        date_published=timezone.now(),
-        number_of_images=total_of_images,
-        total_time=0,                     # ajusta si calculas duraciones
-        parasites_count=total_parasites,
-        leucocytes_count=leukocytes,
-        parasitemia_level=parasitemia_level,
-        diagnosis_result=diagnosis_result
-    )
-    report.save()
+    # O(1): suma los contadores por clase (ver utils_detections)
+    return build_report(sample_id)
 
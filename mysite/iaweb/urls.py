@@ -7,7 +7,19 @@ urlpatterns = [
     #path('find-diagnosis/', views.get_diagnosis, name='findByDiagnosis'),
     #path('report/', views.DiagnosisReportCreateView.as_view(), name='diagnosis_report_create'),
     path('sample/', views.view_sample, name='Sample'),
+    path('samples/', views.list_samples, name='Samples'),
     path('image/', views.view_image, name='Image'),
     path('send-images/', views.ImageCreateView.as_view(), name='Images'),
+    path('sample/<uuid:sample_id>/images/batch/', views.view_image_batch,
+         name='ImageBatch'),
+    path('async/sample/', views.view_sample_async, name='SampleAsync'),
+    path('async/image/', views.view_image_async, name='ImageAsync'),
+    path('upload/', views.upload_session, name='UploadSession'),
+    path('upload/<uuid:pk>/', views.upload_chunk, name='UploadChunk'),
+    path('mosaic/<uuid:pk>.dzi', views.mosaic_dzi, name='MosaicDzi'),
+    path('mosaic/<uuid:pk>_files/<int:level>/<int:col>_<int:row>.jpg',
+         views.mosaic_tile, name='MosaicTile'),
+    path('thumb/<str:field>/<uuid:pk>/<str:size>/', views.thumbnail,
+         name='Thumbnail'),
 
 ]
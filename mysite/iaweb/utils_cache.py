@@ -0,0 +1,81 @@
+# ───────────────────────── utils_cache.py ────────────────────────────
+"""
+Caché versionada del listado ``api/v1/sample/``.
+
+ • Una única clave guarda la versión actual del listado: ``etag`` (token
+   aleatorio) + ``modified`` (cuándo cambió, en segundos enteros y
+   estrictamente creciente). Las señales de ``Sample`` y
+   ``SampleImage`` la renuevan tras el commit.
+ • Las respuestas se cachean bajo ``<prefijo>:<etag>`` ⇒ al cambiar la
+   versión las antiguas quedan huérfanas y caducan solas.
+ • Con ``If-None-Match`` / ``If-Modified-Since`` iguales a la versión la
+   vista responde 304 sin tocar la base de datos.
+ • ``acached_sample_list`` es la variante para las vistas asíncronas:
+   misma clave y mismos datos que ``cached_sample_list``.
+ • ``QuerySet.update()`` y ``bulk_create`` no lanzan señales: quien los use
+   sobre estas tablas debe llamar a ``bump_sample_list``.
+
+"""
+
+import uuid
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+SAMPLE_LIST_KEY  = "iaweb:sample-list:version"
+SAMPLE_LIST_TTL  = 24 * 3600    # vida de cada respuesta cacheada (s)
+
+
+def _new_version():
+    # HTTP-date no tiene fracciones de segundo: se redondea hacia arriba y
+    # siempre avanza, o dos cambios en el mismo segundo darían el mismo
+    # Last-Modified (y un 304 a quien solo envía If-Modified-Since)
+    now = timezone.now()
+    modified = now.replace(microsecond=0)
+    if modified < now:
+        modified += timedelta(seconds=1)
+    prev = cache.get(SAMPLE_LIST_KEY)
+    if prev and modified <= prev["modified"]:
+        modified = prev["modified"] + timedelta(seconds=1)
+    version = {"etag": uuid.uuid4().hex, "modified": modified}
+    cache.set(SAMPLE_LIST_KEY, version, None)
+    return version
+
+
+def sample_list_version():
+    """Versión actual del listado (la crea si la caché está vacía)."""
+    return cache.get(SAMPLE_LIST_KEY) or _new_version()
+
+
+def sample_list_etag(request, *args, **kwargs):
+    return sample_list_version()["etag"]
+
+
+def sample_list_modified(request, *args, **kwargs):
+    return sample_list_version()["modified"]
+
+
+def bump_sample_list():
+    """Invalida el listado cuando la transacción actual haga commit."""
+    transaction.on_commit(_new_version)
+
+
+def cached_sample_list(build):
+    """Datos del listado para la versión actual; ``build()`` si no están."""
+    key = f"iaweb:sample-list:{sample_list_version()['etag']}"
+    return cache.get_or_set(key, build, SAMPLE_LIST_TTL)
+
+
+async def acached_sample_list(build):
+    """Como ``cached_sample_list`` pero con ``build`` asíncrono."""
+    version = await cache.aget(SAMPLE_LIST_KEY)
+    if version is None:
+        version = _new_version()
+    key = f"iaweb:sample-list:{version['etag']}"
+    data = await cache.aget(key)
+    if data is None:
+        data = await build()
+        await cache.aset(key, data, SAMPLE_LIST_TTL)
+    return data
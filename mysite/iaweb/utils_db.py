@@ -0,0 +1,49 @@
+# ───────────────────────── utils_db.py ───────────────────────────────
+"""
+Ajustes de la conexión a la base de datos.
+
+ • SQLite: cada conexión nueva pasa a modo WAL (lectores y un escritor a
+   la vez; el admin ya no bloquea las subidas), ``synchronous=NORMAL``
+   (seguro en WAL, sin fsync por commit), ``busy_timeout`` = el
+   ``timeout`` de ``DATABASES`` y ``mmap`` para las lecturas.
+ • PostgreSQL: nada que hacer aquí; conexiones persistentes
+   (``CONN_MAX_AGE``) en ``settings.DATABASES`` (``IAWEB_DB_*``).
+ • ``manage.py benchmark_db`` mide escrituras/s con varios escritores
+   concurrentes para la configuración activa (en SQLite, sobre una base
+   de datos temporal con los PRAGMAs de cada modo).
+ • ``journal_mode=WAL`` es persistente: queda escrito en la cabecera del
+   fichero de la BD, y sus ``-wal``/``-shm`` no se versionan. Una BD
+   nueva (otra ruta, PostgreSQL) recibe con ``manage.py migrate`` las
+   filas a las que apuntan los ``default=1`` de los modelos.
+
+"""
+
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,     # bytes de la BD mapeados en memoria
+    "temp_store": "MEMORY",
+}
+
+
+def sqlite_pragmas(connection):
+    """PRAGMAs a aplicar a ``connection`` (busy_timeout incluido)."""
+    timeout = connection.settings_dict.get("OPTIONS", {}).get("timeout", 5)
+    return {**SQLITE_PRAGMAS, "busy_timeout": int(timeout * 1000)}
+
+
+def apply_pragmas(cursor, pragmas):
+    """Ejecuta ``pragmas`` en ``cursor`` (de Django o de ``sqlite3``)."""
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        apply_pragmas(cursor, sqlite_pragmas(connection))
@@ -0,0 +1,430 @@
+# ───────────────────────── utils_detect.py ───────────────────────────
+"""
+Detección (YOLOv5/YOLOv8 exportado a ONNX) por lotes en CPU.
+
+ • Nada de inferencia en el ``post_save``: las sub-imágenes sin
+   ``detection_results`` son la cola y ``manage.py run_detection_worker``
+   las procesa en lotes de DETECT_BATCH.
+ • Dos backends intercambiables: OpenCV DNN (viene con opencv-python) y
+   ONNX Runtime (si está instalado, suele ser más rápido en CPU). Ambos
+   usan DETECT_THREADS hilos.
+ • Mientras el modelo procesa un lote, un hilo aparte ya decodifica y
+   redimensiona el siguiente.
+ • Los resultados tienen el formato de ``results.pandas().xyxy`` de
+   YOLOv5 (``xmin``…``ymax``, ``confidence``, ``class``, ``name``) y se
+   guardan junto a la imagen anotada (``detected_image``).
+ • Frames grandes y mosaicos van por teselas del tamaño del modelo con
+   solape (``detect_tiled``), sin reducirlos, y NMS global al final. En
+   los mosaicos cada caja se refiere además a su frame de origen con la
+   disposición que guardó el stitcher (``map_to_frames``).
+
+"""
+
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image
+
+from .models import SampleImage
+from .utils_tiles import DziImage, dzi_path
+
+try:
+    import onnxruntime as ort
+except ImportError:         # opcional: sin él se usa OpenCV DNN
+    ort = None
+
+# ─── parámetros ─────────────────────────────────────────────────────
+DETECT_MODEL   = os.path.join(settings.BASE_DIR, "models", "detector.onnx")
+DETECT_BACKEND = "onnxruntime" if ort else "opencv"
+DETECT_THREADS = os.cpu_count() or 1
+DETECT_INPUT   = 640        # lado de entrada del modelo (px)
+DETECT_BATCH   = 8          # frames por lote
+DETECT_CONF    = 0.25       # confianza mínima
+DETECT_IOU     = 0.45       # IoU de la NMS
+DETECT_CLASSES = [          # en el orden del entrenamiento
+    "leukocytes",
+    "malaria_trophozoite",
+    "malaria_mature_trophozoite",
+]
+DETECT_QUALITY = 85         # calidad JPEG de ``detected_image``
+DETECT_TILE_OVERLAP = 64    # solape entre teselas (px), ≥ objeto mayor
+DETECT_TILED_ABOVE  = 2 * DETECT_INPUT  # lado a partir del cual se tesela
+# mosaico sin pirámide DZI: se decodifica entero, así que solo hasta este
+# tamaño (≈ 3 bytes/píxel en RAM); los mayores necesitan MOSAIC_TILES
+DETECT_MAX_DECODE_PIXELS = 64 * 1024 * 1024
+
+log = logging.getLogger(__name__)
+
+
+# ───── backends ──────────────────────────────────────────────────────
+class OpenCVBackend:
+    def __init__(self, model_path, threads):
+        cv2.setNumThreads(threads)
+        self.net = cv2.dnn.readNetFromONNX(model_path)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        self.batched = True
+
+    def __call__(self, blob):
+        if self.batched:
+            try:
+                self.net.setInput(blob)
+                return self.net.forward()
+            except cv2.error:
+                # exportado con batch fijo = 1: frame a frame
+                self.batched = False
+        out = []
+        for one in blob:
+            self.net.setInput(one[None])
+            out.append(self.net.forward())
+        return np.concatenate(out)
+
+
+class OnnxRuntimeBackend:
+    def __init__(self, model_path, threads):
+        if ort is None:
+            raise RuntimeError("onnxruntime is not installed.")
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = threads
+        opts.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(
+            model_path, opts, providers=["CPUExecutionProvider"])
+        inp = self.session.get_inputs()[0]
+        self.input_name = inp.name
+        self.batched = not isinstance(inp.shape[0], int) or inp.shape[0] > 1
+
+    def __call__(self, blob):
+        if self.batched:
+            return self.session.run(None, {self.input_name: blob})[0]
+        return np.concatenate([
+            self.session.run(None, {self.input_name: one[None]})[0]
+            for one in blob])
+
+
+DETECT_BACKENDS = {
+    "opencv": OpenCVBackend,
+    "onnxruntime": OnnxRuntimeBackend,
+}
+
+
+# ───── pre / post-proceso ────────────────────────────────────────────
+def letterbox(img, size=None):
+    """Redimensiona manteniendo el aspecto y rellena hasta ``size``².
+
+    Devuelve ``(imagen, escala, (pad_x, pad_y))``.
+    """
+    size = size or DETECT_INPUT
+    h, w = img.shape[:2]
+    scale = min(size / w, size / h)
+    nw, nh = round(w * scale), round(h * scale)
+    out = np.full((size, size, 3), 114, np.uint8)
+    px, py = (size - nw) // 2, (size - nh) // 2
+    out[py:py + nh, px:px + nw] = cv2.resize(
+        img, (nw, nh), interpolation=cv2.INTER_AREA if scale < 1
+        else cv2.INTER_LINEAR)
+    return out, scale, (px, py)
+
+
+def _candidates(pred, n_classes):
+    """Filas ``(cx, cy, w, h, score, clase)`` de la salida de un frame.
+
+    YOLOv5: ``(cajas, 5 + nc)`` con objectness; YOLOv8: ``(4 + nc, cajas)``
+    sin ella.
+    """
+    if pred.shape[0] == 4 + n_classes and pred.shape[1] != 4 + n_classes:
+        pred = pred.T
+    if pred.shape[1] == 5 + n_classes:
+        scores = pred[:, 5:] * pred[:, 4:5]
+    else:
+        scores = pred[:, 4:]
+    cls = scores.argmax(1)
+    score = scores[np.arange(len(cls)), cls]
+    return pred[:, :4], score, cls
+
+
+def nms(boxes, scores, classes, iou=None):
+    """NMS por clase (desplaza cada clase para que no se solapen).
+
+    ``boxes`` en ``x0, y0, x1, y1``; devuelve los índices conservados.
+    """
+    if not len(boxes):
+        return np.empty(0, int)
+    offset = classes[:, None] * (boxes.max() + 1)
+    shifted = boxes + offset
+    xywh = np.column_stack([shifted[:, :2], shifted[:, 2:] - shifted[:, :2]])
+    keep = cv2.dnn.NMSBoxes(xywh.tolist(), scores.tolist(), 0.0,
+                            iou or DETECT_IOU)
+    return np.asarray(keep, int).reshape(-1)
+
+
+def decode(pred, scale, pad, shape, classes=None, conf=None):
+    """Cajas de un frame en píxeles de la imagen original."""
+    classes = classes or DETECT_CLASSES
+    xywh, score, cls = _candidates(pred, len(classes))
+    ok = score >= (conf or DETECT_CONF)
+    xywh, score, cls = xywh[ok], score[ok], cls[ok]
+
+    boxes = np.column_stack([xywh[:, :2] - xywh[:, 2:] / 2,
+                             xywh[:, :2] + xywh[:, 2:] / 2])
+    boxes = (boxes - np.tile(pad, 2)) / scale
+    h, w = shape[:2]
+    boxes = boxes.clip(0, [w, h, w, h])
+
+    keep = nms(boxes, score, cls)
+    return [{"xmin": float(b[0]), "ymin": float(b[1]),
+             "xmax": float(b[2]), "ymax": float(b[3]),
+             "confidence": float(s), "class": int(c),
+             "name": classes[c] if c < len(classes) else str(c)}
+            for b, s, c in zip(boxes[keep], score[keep], cls[keep])]
+
+
+def draw_detections(img, detections):
+    out = img.copy()
+    for d in detections:
+        p0 = (int(d["xmin"]), int(d["ymin"]))
+        p1 = (int(d["xmax"]), int(d["ymax"]))
+        color = (0, 0, 255) if d["name"].startswith("malaria") \
+            else (255, 128, 0)
+        cv2.rectangle(out, p0, p1, color, 2)
+        cv2.putText(out, f"{d['name']} {d['confidence']:.2f}",
+                    (p0[0], max(p0[1] - 4, 10)), cv2.FONT_HERSHEY_SIMPLEX,
+                    0.4, color, 1, cv2.LINE_AA)
+    return out
+
+
+# ───── detector ──────────────────────────────────────────────────────
+class Detector:
+    """Modelo cargado una vez; ``detect`` procesa un lote de imágenes BGR."""
+
+    def __init__(self, model_path=None, backend=None, threads=None,
+                 input_size=None):
+        self.model_path = model_path or DETECT_MODEL
+        self.input_size = input_size or DETECT_INPUT
+        self.backend = DETECT_BACKENDS[backend or DETECT_BACKEND](
+            self.model_path, threads or DETECT_THREADS)
+
+    def prepare(self, img):
+        boxed, scale, pad = letterbox(img, self.input_size)
+        return boxed, scale, pad, img.shape
+
+    def detect_prepared(self, prepared):
+        blob = cv2.dnn.blobFromImages([p[0] for p in prepared], 1 / 255.0,
+                                      swapRB=True)
+        preds = self.backend(blob)
+        return [decode(pred, scale, pad, shape)
+                for pred, (_, scale, pad, shape) in zip(preds, prepared)]
+
+    def detect(self, images):
+        return self.detect_prepared([self.prepare(img) for img in images])
+
+
+# ───── cola: sub-imágenes sin detection_results ──────────────────────
+def pending_images():
+    return (SampleImage.objects
+            .filter(detection_results__isnull=True, is_mosaic=False)
+            .order_by("date_published"))
+
+
+def _load(detector, simg):
+    """``(imagen, preparada)``; ``preparada`` es None si va por teselas."""
+    try:
+        img = cv2.imread(simg.image.path, cv2.IMREAD_COLOR)
+    except (ValueError, NotImplementedError):  # storage sin ruta local
+        with simg.image.open("rb") as fh:
+            img = cv2.imdecode(np.frombuffer(fh.read(), np.uint8),
+                               cv2.IMREAD_COLOR)
+    if img is None:
+        return None, None
+    if max(img.shape[:2]) > DETECT_TILED_ABOVE:
+        return img, None
+    return img, detector.prepare(img)
+
+
+def _store(simg, img, detections):
+    ok, enc = cv2.imencode(".jpg", draw_detections(img, detections),
+                           [cv2.IMWRITE_JPEG_QUALITY, DETECT_QUALITY])
+    simg.detection_results = detections
+    simg.detected_image.save("detected.jpg", ContentFile(enc.tobytes()),
+                             save=False)
+    # post_save actualiza los contadores (utils_detections)
+    simg.save(update_fields=["detection_results", "detected_image"])
+
+
+def run_batches(detector, images, batch=None, on_batch=None):
+    """Detecta y guarda ``images`` en lotes; devuelve ``(frames, segundos)``.
+
+    ``on_batch(n, segundos)`` recibe cada lote terminado (para el fps).
+    """
+    batch = batch or DETECT_BATCH
+    chunks = [images[i:i + batch] for i in range(0, len(images), batch)]
+    done, t_total = 0, 0.0
+
+    with ThreadPoolExecutor(max_workers=1,
+                            thread_name_prefix="iaweb-detect-io") as io:
+        def load(chunk):
+            return [_load(detector, simg) for simg in chunk]
+
+        future = io.submit(load, chunks[0]) if chunks else None
+        for i, chunk in enumerate(chunks):
+            t0 = time.perf_counter()
+            loaded = future.result()
+            if i + 1 < len(chunks):
+                future = io.submit(load, chunks[i + 1])
+
+            valid = [(simg, img, prep) for simg, (img, prep)
+                     in zip(chunk, loaded) if prep is not None]
+            for simg, (img, prep) in zip(chunk, loaded):
+                if img is not None and prep is None:
+                    _store(simg, img, detect_tiled(detector, img, batch))
+            for simg, (img, _) in zip(chunk, loaded):
+                if img is None:
+                    # ilegible: resultado vacío para no reintentar siempre
+                    log.warning("No se pudo leer la imagen %s", simg.pk)
+                    simg.detection_results = []
+                    simg.save(update_fields=["detection_results"])
+
+            results = (detector.detect_prepared([p for _, _, p in valid])
+                       if valid else [])
+            for (simg, img, _), dets in zip(valid, results):
+                _store(simg, img, dets)
+
+            dt = time.perf_counter() - t0
+            done += len(chunk)
+            t_total += dt
+            if on_batch:
+                on_batch(len(chunk), dt)
+    return done, t_total
+
+
+# ───── inferencia por teselas ────────────────────────────────────────
+def tile_boxes(shape, size=None, overlap=None):
+    """Teselas ``(x0, y0, x1, y1)`` de lado ``size`` que cubren ``shape``,
+    solapadas ``overlap`` px; la última de cada fila pegada al borde."""
+    size = size or DETECT_INPUT
+    step = size - (DETECT_TILE_OVERLAP if overlap is None else overlap)
+    h, w = shape[:2]
+
+    def starts(n):
+        if n <= size:
+            return [0]
+        return list(range(0, n - size, step)) + [n - size]
+
+    return [(x, y, min(x + size, w), min(y + size, h))
+            for y in starts(h) for x in starts(w)]
+
+
+def _cut_by_tile(d, tile, shape, margin=2):
+    """¿La caja toca un borde interior de la tesela? La vecina, solapada,
+    la ve entera."""
+    x0, y0, x1, y1 = tile
+    h, w = shape[:2]
+    return ((x0 > 0 and d["xmin"] < margin)
+            or (y0 > 0 and d["ymin"] < margin)
+            or (x1 < w and d["xmax"] > x1 - x0 - margin)
+            or (y1 < h and d["ymax"] > y1 - y0 - margin))
+
+
+def detect_tiled(detector, img, batch=None, overlap=None):
+    """Detección a resolución completa sobre ``img`` (array, ``memmap`` o
+    ``DziImage``) por teselas del tamaño del modelo.
+
+    Aparte de ``img``, en memoria solo hay ``batch`` teselas a la vez más
+    las cajas: el pico solo está acotado si ``img`` se lee por zonas
+    (``DziImage`` o ``memmap``), no si es un array ya decodificado.
+    """
+    batch = batch or DETECT_BATCH
+    tiles = tile_boxes(img.shape, detector.input_size, overlap)
+    found = []
+    for i in range(0, len(tiles), batch):
+        chunk = tiles[i:i + batch]
+        prepared = [detector.prepare(np.ascontiguousarray(img[y0:y1, x0:x1]))
+                    for x0, y0, x1, y1 in chunk]
+        for tile, dets in zip(chunk, detector.detect_prepared(prepared)):
+            x0, y0 = tile[:2]
+            found += [dict(d, xmin=d["xmin"] + x0, ymin=d["ymin"] + y0,
+                           xmax=d["xmax"] + x0, ymax=d["ymax"] + y0)
+                      for d in dets if not _cut_by_tile(d, tile, img.shape)]
+
+    if not found:
+        return []
+    boxes = np.array([[d["xmin"], d["ymin"], d["xmax"], d["ymax"]]
+                      for d in found])
+    keep = nms(boxes, np.array([d["confidence"] for d in found]),
+               np.array([d["class"] for d in found]))
+    return [found[k] for k in sorted(keep)]
+
+
+def map_to_frames(detections, layout):
+    """Añade a cada caja del mosaico su frame de origen (``frame``) y la
+    caja en coordenadas de ese frame (``frame_box``)."""
+    w, h = layout["cell"]
+    cols, frames = layout["cols"], layout["frames"]
+    out = []
+    for d in detections:
+        col = int((d["xmin"] + d["xmax"]) / 2 // w)
+        row = int((d["ymin"] + d["ymax"]) / 2 // h)
+        i = row * cols + col
+        if col >= cols or i >= len(frames):
+            out.append(d)                       # celda vacía del lienzo
+            continue
+        image_id, ox, oy = frames[i]
+        cx, cy = col * w, row * h
+        out.append(dict(d, frame=image_id, frame_box=[
+            min(max(d["xmin"] - cx, 0), w) + ox,
+            min(max(d["ymin"] - cy, 0), h) + oy,
+            min(max(d["xmax"] - cx, 0), w) + ox,
+            min(max(d["ymax"] - cy, 0), h) + oy]))
+    return out
+
+
+def pending_mosaics():
+    # los PNG son las cuadrículas de depuración (utils_stitch
+    # ._save_thumbgrid), no mosaicos: no hay nada que detectar en ellas
+    return (SampleImage.objects
+            .filter(detection_results__isnull=True, is_mosaic=True)
+            .exclude(image__iendswith=".png")
+            .order_by("date_published"))
+
+
+def _mosaic_source(mosaic):
+    """Pirámide DZI si existe (lectura por zonas); si no, el JPEG entero,
+    siempre que no pase de DETECT_MAX_DECODE_PIXELS."""
+    name = str(mosaic.pk)
+    if os.path.exists(dzi_path(name)):
+        return DziImage(name)
+    with Image.open(mosaic.image.path) as im:    # solo la cabecera
+        w, h = im.size
+    if w * h > DETECT_MAX_DECODE_PIXELS:
+        raise ValueError(f"Mosaico de {w}x{h} sin pirámide DZI: "
+                         f"demasiado grande para decodificarlo entero")
+    img = cv2.imread(mosaic.image.path, cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("No se pudo leer el mosaico")
+    return img
+
+
+def detect_mosaic(detector, mosaic, batch=None):
+    """Detecta sobre el mosaico completo y guarda las cajas (con su frame
+    de origen si hay disposición). Lee de la pirámide DZI si existe.
+
+    Si el mosaico no se puede procesar se registra el error y se guarda
+    ``[]``, como con los frames ilegibles, para que el worker no vuelva
+    a cogerlo una y otra vez.
+    """
+    try:
+        detections = detect_tiled(detector, _mosaic_source(mosaic), batch)
+        if mosaic.mosaic_layout:
+            detections = map_to_frames(detections, mosaic.mosaic_layout)
+    except Exception:
+        log.exception("Detección fallida en el mosaico %s", mosaic.pk)
+        detections = []
+    # sin detected_image: anotarlo exigiría el lienzo entero en memoria
+    mosaic.detection_results = detections
+    mosaic.save(update_fields=["detection_results"])
+    return detections
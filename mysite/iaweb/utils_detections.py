@@ -0,0 +1,193 @@
+# ───────────────────────── utils_detections.py ───────────────────────
+"""
+Recuento incremental de detecciones para el informe de diagnóstico.
+
+ • Cada ``SampleImage`` guarda en ``detection_counts`` lo que ya aportó
+   a los contadores de su muestra (``DetectionCount``, uno por clase).
+ • Al guardar la imagen solo se suma la diferencia con lo aportado antes;
+   al borrarla se resta (un borrado en bloque, agrupado por muestra y
+   clase). Nunca se vuelve a recorrer la muestra entera.
+ • El informe (``build_report``) sale de sumar unas pocas filas de
+   contadores y se actualiza en sitio: un informe por muestra.
+ • ``count_detections`` recuenta desde ``detection_results`` dentro de la
+   BD (``json_each`` en SQLite, ``jsonb_array_elements`` en PostgreSQL);
+   solo viajan los totales. En otros motores, en Python. Sirve para
+   reconstruir los contadores (``manage.py rebuild_detection_counts``).
+
+"""
+
+import uuid
+from collections import Counter, defaultdict
+
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import DetectionCount, DiagnosisReport, Sample, SampleImage
+from .utils import calculate_parasite_density
+
+LEUKOCYTES  = "leukocytes"
+PARASITES   = ("malaria_trophozoite", "malaria_mature_trophozoite")
+
+
+def detection_counts(results):
+    """Detecciones por clase de una lista ``detection_results``."""
+    return dict(Counter(d["name"] for d in results or []))
+
+
+def _add(sample_id, label, delta):
+    qs = DetectionCount.objects.filter(sample_id=sample_id, label=label)
+    if qs.update(count=F("count") + delta):
+        return
+    try:
+        with transaction.atomic():
+            DetectionCount.objects.create(sample_id=sample_id, label=label,
+                                          count=delta)
+    except IntegrityError:      # la ha creado otra imagen a la vez
+        qs.update(count=F("count") + delta)
+
+
+def apply_detection_counts(simg, applied):
+    """Lleva los contadores de la muestra de ``applied`` (lo aportado
+    antes por ``simg``) a sus ``detection_results`` actuales.
+
+    Los mosaicos no cuentan: repiten lo que ya está en sus frames.
+    """
+    if simg.is_mosaic:
+        return
+    counts = detection_counts(simg.detection_results)
+    applied = applied or {}
+    if counts == applied:
+        return
+    with transaction.atomic():
+        for label in counts.keys() | applied.keys():
+            delta = counts.get(label, 0) - applied.get(label, 0)
+            if delta:
+                _add(simg.sample_id, label, delta)
+        SampleImage.objects.filter(pk=simg.pk).update(
+            detection_counts=counts or None)
+    simg.detection_counts = counts or None
+
+
+def remove_detection_counts(images):
+    """Resta de los contadores lo aportado por ``images`` (queryset de
+    imágenes a punto de borrarse): una lectura y un UPDATE por muestra y
+    clase, sean cuantas sean las imágenes."""
+    removed = defaultdict(Counter)
+    for sample_id, counts in (images.filter(detection_counts__isnull=False)
+                              .values_list("sample_id", "detection_counts")
+                              .iterator()):
+        removed[sample_id].update(counts)
+    for sample_id, counts in removed.items():
+        for label, n in counts.items():
+            DetectionCount.objects.filter(
+                sample_id=sample_id, label=label).update(count=F("count") - n)
+
+
+def sample_detection_totals(sample_id):
+    return Counter(dict(DetectionCount.objects.filter(sample_id=sample_id)
+                        .values_list("label", "count")))
+
+
+def build_report(sample_id):
+    """Crea o actualiza el informe de diagnóstico de la muestra."""
+    totals = sample_detection_totals(sample_id)
+    leukocytes = totals[LEUKOCYTES]
+    total_parasites = sum(totals[label] for label in PARASITES)
+
+    report, _ = DiagnosisReport.objects.update_or_create(
+        sample_id=sample_id,
+        defaults=dict(
+            date_published=timezone.now(),
+            number_of_images=SampleImage.objects.filter(
+                sample_id=sample_id).count(),
+            total_time=0,                 # ajusta si calculas duraciones
+            parasites_count=total_parasites,
+            leucocytes_count=leukocytes,
+            parasitemia_level=calculate_parasite_density(total_parasites,
+                                                         leukocytes),
+            diagnosis_result=total_parasites > 0,
+        ))
+    return report
+
+
+# ───── recuento desde detection_results ──────────────────────────────
+_DETECTION_SQL = {
+    "sqlite": """
+        SELECT si.id, json_extract(d.value, '$.name'), COUNT(*)
+          FROM {table} si, json_each(si.detection_results) d
+         WHERE si.sample_id = %s AND si.is_mosaic = %s
+           AND json_type(si.detection_results) = 'array'
+         GROUP BY si.id, json_extract(d.value, '$.name')""",
+    "postgresql": """
+        SELECT si.id, d ->> 'name', COUNT(*)
+          FROM {table} si
+         CROSS JOIN LATERAL jsonb_array_elements(si.detection_results) d
+         WHERE si.sample_id = %s AND si.is_mosaic = %s
+           AND jsonb_typeof(si.detection_results) = 'array'
+         GROUP BY si.id, d ->> 'name'""",
+}
+
+
+def _detection_rows_db(sample_id):
+    sql = _DETECTION_SQL[connection.vendor].format(
+        table=connection.ops.quote_name(SampleImage._meta.db_table))
+    pk = Sample._meta.pk
+    param = pk.get_db_prep_value(pk.to_python(sample_id), connection)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [param, False])
+        return [(uuid.UUID(str(image_id)), label, n)
+                for image_id, label, n in cursor.fetchall()]
+
+
+def _detection_rows_python(sample_id):
+    images = (SampleImage.objects.filter(sample_id=sample_id, is_mosaic=False)
+              .filter(detection_results__isnull=False)
+              .values_list("id", "detection_results"))
+    rows = []
+    for image_id, results in images.iterator():
+        if isinstance(results, list):
+            rows += [(image_id, label, n)
+                     for label, n in detection_counts(results).items()]
+    return rows
+
+
+def detection_rows(sample_id, use_db=True):
+    """``(imagen, clase, n)`` de las imágenes de la muestra."""
+    if use_db and connection.vendor in _DETECTION_SQL:
+        try:
+            with transaction.atomic():
+                return _detection_rows_db(sample_id)
+        except DatabaseError:       # SQLite sin JSON1, p. ej.
+            pass
+    return _detection_rows_python(sample_id)
+
+
+def count_detections(sample_id, use_db=True):
+    """Detecciones por clase de la muestra, sin pasar por los contadores."""
+    totals = Counter()
+    for _, label, n in detection_rows(sample_id, use_db):
+        totals[label] += n
+    return totals
+
+
+def rebuild_detection_counts(sample_id):
+    """Rehace los contadores de la muestra (y lo aportado por cada imagen)
+    a partir de ``detection_results``."""
+    per_image = defaultdict(dict)
+    totals = Counter()
+    for image_id, label, n in detection_rows(sample_id):
+        per_image[image_id][label] = n
+        totals[label] += n
+
+    with transaction.atomic():
+        DetectionCount.objects.filter(sample_id=sample_id).delete()
+        DetectionCount.objects.bulk_create(
+            DetectionCount(sample_id=sample_id, label=label, count=n)
+            for label, n in totals.items())
+        images = SampleImage.objects.filter(sample_id=sample_id,
+                                            is_mosaic=False)
+        images.exclude(pk__in=per_image).update(detection_counts=None)
+        for image_id, counts in per_image.items():
+            images.filter(pk=image_id).update(detection_counts=counts)
+    return totals
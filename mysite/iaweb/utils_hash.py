@@ -0,0 +1,96 @@
+# ───────────────────────── utils_hash.py ─────────────────────────────
+"""
+Índice en espacio de Hamming para hashes perceptuales de 64 bits.
+
+ • BK-tree: cada nodo guarda sus hijos por distancia al padre; por la
+   desigualdad triangular una búsqueda de radio ``r`` solo baja por los
+   hijos con distancia en ``[d - r, d + r]``.
+ • Con radios pequeños (1-4 bits) cada consulta visita una fracción
+   mínima del árbol ⇒ deduplicar ``n`` frames deja de ser O(n²).
+
+"""
+
+import random
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+def phash_to_int(phash):
+    """Convierte un ``imagehash.ImageHash`` o su cadena hex en entero."""
+    return int(str(phash), 16)
+
+
+class HammingIndex:
+    """BK-tree sobre enteros; cada valor lleva asociada una clave."""
+
+    def __init__(self):
+        self._root = None       # [valor, [claves], {distancia: nodo}]
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    @classmethod
+    def build(cls, items, shuffle=True):
+        """Crea el índice a partir de pares ``(valor, clave)``.
+
+        Barajar antes de insertar evita árboles degenerados cuando los
+        valores llegan ordenados.
+        """
+        items = list(items)
+        if shuffle:
+            random.Random(0).shuffle(items)
+        index = cls()
+        for value, key in items:
+            index.add(value, key)
+        return index
+
+    def add(self, value, key=None):
+        self._size += 1
+        if self._root is None:
+            self._root = [value, [key], {}]
+            return
+        node = self._root
+        while True:
+            d = hamming(value, node[0])
+            if d == 0:
+                node[1].append(key)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, [key], {}]
+                return
+            node = child
+
+    def query(self, value, radius):
+        """Lista de ``(clave, distancia)`` a distancia ≤ ``radius``."""
+        out = []
+        if self._root is None:
+            return out
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            d = hamming(value, node[0])
+            if d <= radius:
+                out.extend((key, d) for key in node[1])
+            for dist, child in node[2].items():
+                if d - radius <= dist <= d + radius:
+                    stack.append(child)
+        return out
+
+    def contains_within(self, value, radius):
+        """Igual que ``bool(query(...))`` pero se para en el primer acierto."""
+        if self._root is None:
+            return False
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            d = hamming(value, node[0])
+            if d <= radius:
+                return True
+            for dist, child in node[2].items():
+                if d - radius <= dist <= d + radius:
+                    stack.append(child)
+        return False
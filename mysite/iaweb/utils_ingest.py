@@ -0,0 +1,63 @@
+# ───────────────────────── utils_ingest.py ───────────────────────────
+"""
+Etapa de ingesta: al subir una sub-imagen se calculan en segundo plano
+sus métricas de calidad (``FrameFeatures``: recorte, % negro/blanco,
+textura, nitidez, pHash) y su miniatura para el admin (``utils_thumbs``).
+
+ • El ``post_save`` solo encola el id tras el commit ⇒ la petición de
+   subida no espera a OpenCV.
+ • Un pool de hilos local hace el trabajo (OpenCV suelta el GIL).
+ • ``manage.py precompute_features`` rellena lo que falte (imágenes
+   antiguas o subidas mientras el servidor estaba caído).
+
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections, transaction
+
+from .models import SampleImage
+from .utils_stitch import compute_frame_features
+from .utils_thumbs import ensure_thumbnail
+
+INGEST_WORKERS = 2          # hilos de ingesta (0 = síncrono, en la petición)
+
+log = logging.getLogger(__name__)
+_executor = None
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS,
+                                       thread_name_prefix="iaweb-ingest")
+    return _executor
+
+
+def ingest_image(image_id):
+    """Calcula las métricas de una imagen; nunca lanza excepciones."""
+    try:
+        simg = SampleImage.objects.get(pk=image_id)
+        compute_frame_features(simg)
+        ensure_thumbnail(simg.image, "s")
+    except Exception:
+        log.exception("Ingesta fallida para la imagen %s", image_id)
+
+
+def _ingest_in_thread(image_id):
+    # los hilos del pool no pasan por request_started/finished
+    close_old_connections()
+    try:
+        ingest_image(image_id)
+    finally:
+        close_old_connections()
+
+
+def schedule_ingest(image_id):
+    """Encola la ingesta de ``image_id`` cuando la transacción haga commit."""
+    if INGEST_WORKERS <= 0:
+        transaction.on_commit(lambda: ingest_image(image_id))
+        return
+    transaction.on_commit(
+        lambda: _get_executor().submit(_ingest_in_thread, image_id))
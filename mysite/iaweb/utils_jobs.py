@@ -0,0 +1,185 @@
+# ───────────────────────── utils_jobs.py ─────────────────────────────
+"""
+Cola de trabajos de stitching guardada en la base de datos.
+
+ • El admin solo crea filas ``StitchJob`` (milisegundos).
+ • ``python manage.py run_stitch_worker`` las recoge una a una, ejecuta
+   ``stitch_cropped`` + ``save_mosaic`` y va guardando el progreso
+   (frames revisados / conservados).
+ • Si un trabajo falla se reintenta hasta ``max_attempts`` veces, cada
+   vez tras una espera mayor (RETRY_BACKOFF_S × 2^(intento-1)).
+ • Un error que no depende del intento (``NoFramesError``: ningún
+   frame útil) marca el trabajo como fallido a la primera.
+ • El worker renueva ``heartbeat`` al reclamar el trabajo y, desde un
+   hilo, cada HEARTBEAT_S mientras lo ejecuta (también al montar el
+   lienzo, codificar el JPEG y generar las teselas, que no informan
+   progreso); ``requeue_stale_jobs`` solo devuelve a la cola los
+   trabajos *running* cuyo latido lleva más de JOB_LEASE_S parado
+   (worker caído), nunca los que otro worker sigue ejecutando.
+ • Cada reclamación queda identificada por su ``date_started``: un
+   worker al que le han quitado el trabajo no renueva el latido ni
+   guarda su resultado (el mosaico que haya creado se borra).
+
+"""
+
+import logging
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.db import DatabaseError, connection
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import StitchJob
+from .utils_stitch import NoFramesError, save_mosaic, stitch_with_layout
+from .utils_tiles import remove_dzi
+
+PROGRESS_EVERY_S = 1.0      # cada cuánto se vuelca el progreso a la BD
+JOB_LEASE_S      = 300      # latido más viejo que esto ⇒ worker caído
+HEARTBEAT_S      = 60       # cada cuánto renueva el latido el worker
+RETRY_BACKOFF_S  = 60       # espera antes del 1.er reintento (se duplica)
+
+log = logging.getLogger(__name__)
+
+_STITCHERS = {              # devuelven (lienzo, disposición)
+    StitchJob.CIRCULAR: stitch_with_layout,
+    StitchJob.CROPPED: stitch_with_layout,
+}
+
+
+# ───── encolar ───────────────────────────────────────────────────────
+def enqueue_stitch(sample, kind):
+    """Crea un trabajo pendiente salvo que ya exista uno sin terminar."""
+    job = StitchJob.objects.filter(
+        sample=sample, kind=kind,
+        status__in=(StitchJob.PENDING, StitchJob.RUNNING)).first()
+    if job:
+        return job, False
+    return StitchJob.objects.create(sample=sample, kind=kind), True
+
+
+# ───── reclamar el siguiente trabajo ─────────────────────────────────
+def claim_next_job():
+    """Marca como *running* el trabajo pendiente más antiguo (de los que
+    no están esperando a reintentarse).
+
+    El ``UPDATE ... WHERE status='pending'`` condicional hace que dos
+    workers no puedan quedarse con el mismo trabajo.
+    """
+    while True:
+        now = timezone.now()
+        job = (StitchJob.objects.filter(status=StitchJob.PENDING)
+               .filter(Q(retry_after__isnull=True) | Q(retry_after__lte=now))
+               .order_by('date_created').first())
+        if job is None:
+            return None
+        claimed = StitchJob.objects.filter(
+            pk=job.pk, status=StitchJob.PENDING).update(
+                status=StitchJob.RUNNING, date_started=now, heartbeat=now)
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+# ───── ejecutar ──────────────────────────────────────────────────────
+def _owned(job):
+    """El trabajo, solo si sigue siendo de esta reclamación."""
+    return StitchJob.objects.filter(pk=job.pk, status=StitchJob.RUNNING,
+                                    date_started=job.date_started)
+
+
+def _progress_writer(job):
+    last = [0.0]
+
+    def progress(scanned, kept, total):
+        now = time.monotonic()
+        if scanned < total and now - last[0] < PROGRESS_EVERY_S:
+            return
+        last[0] = now
+        _owned(job).update(
+            frames_scanned=scanned, frames_kept=kept, frames_total=total,
+            heartbeat=timezone.now())
+
+    return progress
+
+
+@contextmanager
+def _heartbeat(job):
+    """Renueva el latido de ``job`` cada HEARTBEAT_S mientras dura el
+    bloque, con su propia conexión a la BD."""
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(HEARTBEAT_S):
+                try:
+                    _owned(job).update(heartbeat=timezone.now())
+                except DatabaseError:
+                    log.warning("No se pudo renovar el latido de %s", job,
+                                exc_info=True)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat, daemon=True,
+                              name=f"heartbeat-{job.pk}")
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def run_job(job, workers=None):
+    """Ejecuta ``job`` y deja su estado final en la base de datos."""
+    job.attempts += 1
+    try:
+        with _heartbeat(job):
+            pano, layout = _STITCHERS[job.kind](job.sample, workers,
+                                                _progress_writer(job))
+            job.mosaic = save_mosaic(job.sample, pano, job.kind, layout)
+        job.status = StitchJob.DONE
+        job.error = ''
+    except NoFramesError:
+        job.error = traceback.format_exc()
+        job.status = StitchJob.FAILED
+    except Exception:
+        job.error = traceback.format_exc()
+        if job.attempts < job.max_attempts:
+            job.status = StitchJob.PENDING
+            job.retry_after = timezone.now() + timedelta(
+                seconds=RETRY_BACKOFF_S * 2 ** (job.attempts - 1))
+        else:
+            job.status = StitchJob.FAILED
+    job.date_finished = timezone.now()
+    job.heartbeat = None
+    finished = _owned(job).update(
+        attempts=job.attempts, status=job.status, error=job.error,
+        mosaic=job.mosaic, date_finished=job.date_finished, heartbeat=None,
+        retry_after=job.retry_after)
+    if not finished:
+        # latido perdido y trabajo reclamado por otro worker: manda el suyo
+        log.warning("%s ya no es de este worker; se descarta el resultado",
+                    job)
+        if job.mosaic is not None:
+            remove_dzi(str(job.mosaic.pk))
+            job.mosaic.delete()
+        job.refresh_from_db()
+        return job
+    job.refresh_from_db(fields=['frames_total', 'frames_scanned',
+                                'frames_kept'])
+    return job
+
+
+def requeue_stale_jobs(lease=None):
+    """Devuelve a la cola los trabajos *running* sin latido desde hace más
+    de ``lease`` segundos (su worker se ha caído)."""
+    lease = JOB_LEASE_S if lease is None else lease
+    stale = timezone.now() - timedelta(seconds=lease)
+    return StitchJob.objects.filter(status=StitchJob.RUNNING).filter(
+        Q(heartbeat__lt=stale)
+        | Q(heartbeat__isnull=True, date_started__lt=stale)).update(
+            status=StitchJob.PENDING, heartbeat=None)
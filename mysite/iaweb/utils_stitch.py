@@ -6,21 +6,43 @@ Construye un mosaico de mini-fotos (tipo *contact-sheet*) en cuadrícula.
        – se recorta al mayor cuadrado inscrito en el ocular
        – **no lleva marco negro permanente**
  • Filtros rápidos:
-       – descarta fotos casi negras, casi blancas o con pocos puntos SIFT
-       – evita duplicados con hash perceptual (pHash)
+       – descarta fotos casi negras, casi blancas o con poca textura
+         (puntos SIFT u otro backend más barato, ver TEXTURE_BACKEND) y,
+         con MIN_SHARPNESS > 0, las desenfocadas
+       – evita duplicados con hash perceptual (pHash) usando un BK-tree
  • Antes de montar el mosaico TODAS las teselas se igualan al mismo
    tamaño ⇒ ya no aparecen líneas negras por desajustes de 1-2 px.
  • Se guarda un JPEG final y (opcional) un PNG de depuración con la
    rejilla dibujada.
+ • Las métricas de cada frame (caja de recorte, % negro/blanco, puntos
+   textura, pHash) se guardan en ``FrameFeatures``; al re-stitchear solo
+   se decodifican los frames nuevos o los que cambian de veredicto.
+   La ingesta (``signals``) las calcula ya al subir cada imagen, así
+   que los frames descartados se excluyen con una sola consulta SQL.
+ • Modo *streaming* (STREAM_MOSAIC): la 1.ª pasada solo guarda el
+   veredicto y la caja de recorte; la 2.ª relee los frames útiles uno a
+   uno y los escribe directamente en el lienzo ⇒ pico de memoria ≈ un
+   frame + el lienzo.
+ • Opcionalmente (MOSAIC_TILES) el mosaico también se guarda como
+   pirámide de teselas DZI para verlo por zonas desde el navegador.
 
 """
 
-import os, cv2, numpy as np, time, math, random
+import os, cv2, numpy as np, time, math, random, tempfile, hashlib
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from io import BytesIO
 from PIL import Image
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Q
 from django.core.files.base import ContentFile
 from tqdm import tqdm
 
+from .utils_hash import HammingIndex, phash_to_int
+from .utils_tiles import remove_dzi, save_dzi
+
 # ───── Intenta usar imagehash para detectar duplicados ───────────────
 try:
     import imagehash
@@ -44,24 +66,85 @@ BORDER_THUMB     = 1        # borde solo en el PNG de depuración
 THUMB_GRID_SIDE  = 150      # tamaño de cada miniatura en el PNG
 DEBUG_MOSAIC     = True     # guarda el PNG de depuración
 HASH_DIST_MAX    = 1        # distancia de Hamming máx. para duplicados
-
-_sift = cv2.SIFT_create()
+BLACK_LEVEL      = 30       # gris < 30  → píxel negro (y fuera del ocular)
+WHITE_LEVEL      = 225      # gris > 225 → píxel blanco
+FILTER_WORKERS   = os.cpu_count() or 1   # procesos para filtrar (1 = en serie)
+FILTER_CHUNK     = 4        # frames por lote (y por envío a cada proceso)
+STREAM_MOSAIC    = True     # 2 pasadas: no guarda los frames en memoria
+MOSAIC_MEMMAP_DIR = None    # carpeta para un lienzo en disco (None = RAM)
+TRUST_FEATURES   = True     # descarta por SQL sin comprobar el checksum
+REDUCED_DECODE   = True     # JPEG decodificado ya a DOWNSCALE_FACTOR
+MOSAIC_TILES     = True     # además del JPEG, pirámide DZI (utils_tiles)
+
+# Filtro de textura: "sift" (referencia) o una alternativa más barata.
+# Los umbrales de las alternativas se ajustan con
+# `manage.py calibrate_texture` para que descarten lo mismo que SIFT.
+TEXTURE_BACKEND  = "sift"   # sift | fast | orb | gradient | laplacian
+TEXTURE_MIN      = {        # score < umbral → descartar
+    "fast":      150,
+    "orb":       120,
+    "gradient":  120.0,
+    "laplacian": 60.0,
+}
+FAST_THRESHOLD   = 20       # umbral de intensidad del detector FAST
+ORB_MAX_FEATURES = 2000     # tope de esquinas que devuelve ORB
+
+# Nitidez (varianza del laplaciano de la miniatura en gris, depende de
+# DOWNSCALE_FACTOR): se guarda siempre; descarta solo si el umbral > 0.
+MIN_SHARPNESS    = 0.0      # sharpness < umbral → descartar (0 = no filtra)
+
+# Los detectores de OpenCV no se deben compartir entre hilos (la ingesta
+# usa un pool de hilos): uno de cada por hilo, creado al primer uso.
+_detectors = threading.local()
+
+def _detector(name):
+    det = getattr(_detectors, name, None)
+    if det is None:
+        det = {"sift": cv2.SIFT_create,
+               "fast": lambda: cv2.FastFeatureDetector_create(
+                   threshold=FAST_THRESHOLD),
+               "orb": lambda: cv2.ORB_create(
+                   nfeatures=ORB_MAX_FEATURES)}[name]()
+        setattr(_detectors, name, det)
+    return det
 
 # ───── helpers de recorte ────────────────────────────────────────────
-def _crop_circle_to_square(img):
-    """Recorta el mayor cuadrado inscrito en la foto del ocular."""
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    _, m = cv2.threshold(gray, 30, 255, cv2.THRESH_BINARY)
+def _crop_box_gray(gray, size=None):
+    """Caja ``(x0, y0, x1, y1)`` del mayor cuadrado inscrito en el ocular
+    (a partir de la imagen ya en gris), ajustada a los bordes.
+
+    Si ``gray`` es una versión reducida de una imagen de ``size``
+    ``(ancho, alto)``, el círculo se busca en la reducida y la caja se
+    devuelve en coordenadas de la imagen completa.
+    """
+    _, m = cv2.threshold(gray, BLACK_LEVEL, 255, cv2.THRESH_BINARY)
     cnts, _ = cv2.findContours(m, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    h, w = gray.shape[:2]
+    sx, sy = (1, 1) if size is None else (size[0] / w, size[1] / h)
+    w, h = round(w * sx), round(h * sy)
     if not cnts:                         # si está vacía
-        return img
+        return 0, 0, w, h
 
     (x, y), r = cv2.minEnclosingCircle(max(cnts, key=cv2.contourArea))
+    x, y, r = x * sx, y * sy, r * sx
     half = int(r / math.sqrt(2))         # mitad del cuadrado inscrito
     cx, cy = int(x), int(y)
     x0, y0, x1, y1 = cx - half, cy - half, cx + half, cy + half
-    sq = img[max(0, y0):min(img.shape[0], y1),
-             max(0, x0):min(img.shape[1], x1)].copy()
+    return max(0, x0), max(0, y0), min(w, x1), min(h, y1)
+
+def _crop_box(img):
+    return _crop_box_gray(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY))
+
+def _scale_box(box, shape, size):
+    """Pasa una caja de la imagen completa (``size``) a una reducida
+    (``shape``)."""
+    sx, sy = size[0] / shape[1], size[1] / shape[0]
+    x0, y0, x1, y1 = box
+    return (round(x0 / sx), round(y0 / sy), round(x1 / sx), round(y1 / sy))
+
+def _apply_box(img, box):
+    x0, y0, x1, y1 = box
+    sq = img[y0:y1, x0:x1].copy()
 
     # solo si quisieras volver a poner borde permanente
     if BORDER_PX:
@@ -71,26 +154,118 @@ def _crop_circle_to_square(img):
         )
     return sq
 
+def _box_shape(box):
+    """Alto y ancho de la tesela que sale de ``_apply_box``."""
+    x0, y0, x1, y1 = box
+    return y1 - y0 + 2 * BORDER_PX, x1 - x0 + 2 * BORDER_PX
+
+def _crop_circle_to_square(img):
+    """Recorta el mayor cuadrado inscrito en la foto del ocular."""
+    return _apply_box(img, _crop_box(img))
+
+def _downscale(img):
+    return cv2.resize(img, None, fx=DOWNSCALE_FACTOR, fy=DOWNSCALE_FACTOR)
+
 # ───── filtros rápidos ───────────────────────────────────────────────
-def _mostly_black(img):
+def _gray_ratios(grays):
+    """Fracción de píxeles negros (< BLACK_LEVEL) y blancos (> WHITE_LEVEL)
+    de cada miniatura en gris.
+
+    Toda la pila se resuelve con un único ``bincount`` sobre el
+    histograma conjunto (fila = frame), sin bucles Python por frame.
+    Devuelve dos arrays ``(negro, blanco)``.
+    """
+    sizes = np.array([g.size for g in grays])
+    ids = np.repeat(np.arange(len(grays)) * 256, sizes)
+    flat = np.concatenate([g.ravel() for g in grays])
+    hist = np.bincount(ids + flat, minlength=256 * len(grays))\
+             .reshape(len(grays), 256)
+    black = hist[:, :BLACK_LEVEL].sum(axis=1) / sizes
+    white = hist[:, WHITE_LEVEL + 1:].sum(axis=1) / sizes
+    return black, white
+
+def _black_ratio(img):
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    return (gray < 30).mean() >= BLACK_RATIO
+    return float(_gray_ratios([gray])[0][0])
 
-def _mostly_white(img):
+def _white_ratio(img):
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    return (gray > 225).mean() >= WHITE_RATIO
+    return float(_gray_ratios([gray])[1][0])
+
+# ───── backends de textura (reciben la miniatura en gris) ────────────
+def _texture_sift(gray):
+    return len(_detector("sift").detect(gray, None))
+
+def _texture_fast(gray):
+    return len(_detector("fast").detect(gray, None))
+
+def _texture_orb(gray):
+    return len(_detector("orb").detect(gray, None))
+
+def _texture_gradient(gray):
+    """Energía media del gradiente (Sobel)."""
+    gx = cv2.Sobel(gray, cv2.CV_32F, 1, 0)
+    gy = cv2.Sobel(gray, cv2.CV_32F, 0, 1)
+    return cv2.mean(cv2.magnitude(gx, gy) ** 2)[0]
+
+def _texture_laplacian(gray):
+    """Varianza del laplaciano: baja en frames desenfocados."""
+    return cv2.Laplacian(gray, cv2.CV_64F).var()
+
+TEXTURE_BACKENDS = {
+    "sift":      _texture_sift,
+    "fast":      _texture_fast,
+    "orb":       _texture_orb,
+    "gradient":  _texture_gradient,
+    "laplacian": _texture_laplacian,
+}
+
+def _min_texture(backend=None):
+    backend = TEXTURE_BACKEND if backend is None else backend
+    return MIN_KEYPOINTS if backend == "sift" else TEXTURE_MIN[backend]
+
+def _texture_score(gray, backend=None):
+    backend = TEXTURE_BACKEND if backend is None else backend
+    return float(TEXTURE_BACKENDS[backend](gray))
+
+def _mostly_black(img):
+    return _black_ratio(img) >= BLACK_RATIO
+
+def _mostly_white(img):
+    return _white_ratio(img) >= WHITE_RATIO
 
 def _too_few_features(img):
-    kp = _sift.detect(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), None)
-    return len(kp) < MIN_KEYPOINTS
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    return _texture_score(gray) < _min_texture()
 
 def _is_duplicate(phash, seen):
+    """``seen`` es un ``HammingIndex`` con los pHash (enteros) ya aceptados."""
     if not _USE_HASH:
         return False
-    return any(phash - h <= HASH_DIST_MAX for h in seen)
+    return seen.contains_within(phash, HASH_DIST_MAX)
+
+def _verdict(m):
+    """``True`` si las métricas ``m`` descartan el frame, ``False`` si pasa
+    y ``None`` si faltan datos para decidir (p. ej. no se midió la
+    textura porque la vez anterior ya se descartó por negro)."""
+    if m["black_ratio"] >= BLACK_RATIO or m["white_ratio"] >= WHITE_RATIO:
+        return True
+    if m["texture_score"] is None:
+        return None
+    if m["texture_score"] < _min_texture():
+        return True
+    if MIN_SHARPNESS:
+        if m["sharpness"] is None:
+            return None
+        if m["sharpness"] < MIN_SHARPNESS:
+            return True
+    if _USE_HASH and m["phash"] is None:
+        return None
+    return False
 
 # ───── cuadrícula-debug (“contact sheet”) ────────────────────────────
 def _save_thumbgrid(imgs, sample, suffix="thumbs"):
+    imgs = [im for im in imgs if im is not None]
     if not (DEBUG_MOSAIC and imgs):
         return
     cols = int(math.sqrt(len(imgs)))
@@ -109,12 +284,18 @@ def _save_thumbgrid(imgs, sample, suffix="thumbs"):
     rgb = cv2.cvtColor(grid, cv2.COLOR_BGR2RGB)
     buf = BytesIO()
     Image.fromarray(rgb).save(buf, "PNG")
+    # detection_results=[]: el worker de detección no la trata como mosaico
     sample.images.create(
-        is_mosaic=True,
+        is_mosaic=True, detection_results=[],
         image=ContentFile(buf.getvalue(), name=f"{sample.id}_{suffix}.png")
     )
 
 # ───── normalización de tamaño ───────────────────────────────────────
+def _center_crop(im, h, w):
+    y0 = (im.shape[0] - h) // 2
+    x0 = (im.shape[1] - w) // 2
+    return im[y0:y0 + h, x0:x0 + w]
+
 def _standardize_tiles(imgs):
     """Recorta todas las teselas al mismo (mínimo) tamaño para
     que casen sin dejar huecos negros."""
@@ -122,89 +303,439 @@ def _standardize_tiles(imgs):
         return imgs
     h_min = min(im.shape[0] for im in imgs)
     w_min = min(im.shape[1] for im in imgs)
-    std = []
-    for im in imgs:
-        h, w = im.shape[:2]
-        y0 = (h - h_min) // 2
-        x0 = (w - w_min) // 2
-        std.append(im[y0:y0 + h_min, x0:x0 + w_min])
-    return std
+    return [_center_crop(im, h_min, w_min) for im in imgs]
+
+# ───── caché de métricas (FrameFeatures) ─────────────────────────────
+def _feature_params():
+    """Firma de los parámetros que cambian las métricas guardadas.
+
+    v2: la miniatura se reduce ya en gris (antes en color y luego a gris)
+    y el pHash sale del gris de OpenCV en lugar del modo "L" de PIL.  Es
+    un cambio de resultados aceptado: los % de negro/blanco pueden variar
+    en algún píxel y el pHash en algún bit, así que un frame en el límite
+    de un umbral o de HASH_DIST_MAX puede cambiar de veredicto.  Las
+    métricas v1 no se reutilizan; los veredictos de referencia están
+    fijados en ``tests.FrameFilterTests``.
+    """
+    return (f"v2:{DOWNSCALE_FACTOR}:{BORDER_PX}:{_USE_HASH}:"
+            f"{TEXTURE_BACKEND}:{_reduced_flag() is not None}")
+
+def _cached_metrics(simg, params):
+    try:
+        f = simg.features
+    except ObjectDoesNotExist:
+        return None
+    if f.params != params:
+        return None
+    stamp = (f.file_size, f.file_mtime) if f.file_mtime is not None else None
+    return {"checksum": f.checksum, "stamp": stamp, "box": f.box,
+            "black_ratio": f.black_ratio, "white_ratio": f.white_ratio,
+            "texture_score": f.texture_score, "phash": f.phash,
+            "sharpness": f.sharpness}
+
+def _store_metrics(simg, m, params):
+    from .models import FrameFeatures
+
+    x0, y0, x1, y1 = m["box"]
+    size, mtime = m["stamp"]
+    feats, _ = FrameFeatures.objects.update_or_create(
+        image=simg,
+        defaults=dict(checksum=m["checksum"], params=params,
+                      file_size=size, file_mtime=mtime,
+                      box_x0=x0, box_y0=y0, box_x1=x1, box_y1=y1,
+                      black_ratio=m["black_ratio"],
+                      white_ratio=m["white_ratio"],
+                      texture_score=m["texture_score"], phash=m["phash"],
+                      sharpness=m["sharpness"]))
+    if m["mini"] is not None and _verdict(m) is False:
+        thumb = cv2.resize(m["mini"], (THUMB_GRID_SIDE, THUMB_GRID_SIDE))
+        ok, enc = cv2.imencode(".jpg", thumb)
+        feats.thumbnail.delete(save=False)
+        feats.thumbnail.save("thumb.jpg", ContentFile(enc.tobytes()))
+    return feats
+
+def rejected_frames_q(params=None):
+    """``Q`` de los ``SampleImage`` que la caché ya descarta con los
+    umbrales actuales (sin abrir ningún fichero)."""
+    params = _feature_params() if params is None else params
+    q = (Q(features__black_ratio__gte=BLACK_RATIO)
+         | Q(features__white_ratio__gte=WHITE_RATIO)
+         | Q(features__texture_score__lt=_min_texture()))
+    if MIN_SHARPNESS:
+        q |= Q(features__sharpness__lt=MIN_SHARPNESS)
+    return Q(features__params=params) & q
+
+def usable_frames_q(params=None):
+    """``Q`` de los frames que la caché da por buenos (pueden seguir
+    siendo duplicados: eso se decide al montar el mosaico)."""
+    params = _feature_params() if params is None else params
+    q = Q(is_mosaic=False, features__params=params,
+          features__black_ratio__lt=BLACK_RATIO,
+          features__white_ratio__lt=WHITE_RATIO,
+          features__texture_score__gte=_min_texture())
+    if MIN_SHARPNESS:
+        q &= Q(features__sharpness__gte=MIN_SHARPNESS)
+    return q
+
+def compute_frame_features(simg):
+    """Calcula y guarda todas las métricas de ``simg`` (etapa de ingesta)."""
+    params = _feature_params()
+    m = _analyze_frame((simg.image.path, None), keep_full=False,
+                       complete=True)
+    return _store_metrics(simg, m, params)
+
+def _cached_thumb(simg):
+    f = getattr(simg, "features", None)
+    if f is None or not f.thumbnail:
+        return None
+    return cv2.imread(f.thumbnail.path)
+
+# ───── análisis de un frame (se ejecuta en los procesos del pool) ────
+def _init_filter_worker():
+    """Un hilo de OpenCV por proceso: el paralelismo lo pone el pool."""
+    cv2.setNumThreads(1)
+
+def _phash(gray_mini):
+    return str(imagehash.phash(Image.fromarray(gray_mini)))
+
+def _decode(data):
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+def _jpeg_size(data):
+    """(ancho, alto) de un JPEG leyendo solo la cabecera, ya girado según
+    la orientación EXIF (como hace ``cv2.imdecode``)."""
+    with Image.open(BytesIO(data)) as im:
+        w, h = im.size
+        if im.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+            w, h = h, w
+    return w, h
+
+def _reduced_flag():
+    """Flag ``IMREAD_REDUCED_*`` equivalente a DOWNSCALE_FACTOR, o None."""
+    if not REDUCED_DECODE:
+        return None
+    return {0.5: cv2.IMREAD_REDUCED_COLOR_2,
+            0.25: cv2.IMREAD_REDUCED_COLOR_4,
+            0.125: cv2.IMREAD_REDUCED_COLOR_8}.get(DOWNSCALE_FACTOR)
+
+def _prepare(data, keep_full=True):
+    """Decodifica un frame para los filtros.
+
+    Devuelve ``box`` (en coordenadas de la imagen completa), ``gray`` y
+    ``mini`` (miniaturas del recorte en gris y color) e ``img`` (recorte
+    a resolución completa, solo con ``keep_full`` y si ya se decodificó).
+
+    Los JPEG se decodifican directamente a 1/2, 1/4 u 1/8 (libjpeg escala
+    durante la IDCT) cuando DOWNSCALE_FACTOR coincide: la resolución
+    completa solo se decodifica luego para los frames que pasan.
+    """
+    flag = _reduced_flag()
+    if flag is not None and data[:2] == b"\xff\xd8":
+        small = cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+        size = _jpeg_size(data)
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        box = _crop_box_gray(gray, size)
+        sbox = _scale_box(box, small.shape, size)
+        return {"box": box, "gray": _apply_box(gray, sbox),
+                "mini": _apply_box(small, sbox), "img": None}
+
+    img = _decode(data)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    box = _crop_box_gray(gray)
+    img = _apply_box(img, box)
+    return {"box": box, "gray": _downscale(_apply_box(gray, box)),
+            "mini": _downscale(img), "img": img if keep_full else None}
+
+def _gray_mini(path):
+    """Miniatura en gris del recorte, igual que la que usan los filtros."""
+    with open(path, "rb") as fh:
+        return _prepare(fh.read(), keep_full=False)["gray"]
+
+def _analyze_batch(jobs, keep_full=True, complete=False):
+    """Calcula (o reaprovecha) las métricas de un lote de frames.
+
+    Cada job es ``(ruta, métricas_en_caché | None)``.  Si la caché sigue
+    valiendo y basta para decidir, el frame no se decodifica salvo que
+    pase y haga falta ``img`` (recorte a resolución completa, solo con
+    ``keep_full``; en modo streaming basta la caja).  La caché vale si el
+    ``stat`` (tamaño, mtime) es el guardado, sin leer el fichero; si no,
+    se lee y se compara el checksum (y, si coincide, se renueva el
+    ``stat`` guardado).
+
+    Los frames que sí se analizan se decodifican ya reducidos cuando se
+    puede (ver ``_prepare``) y se pasan a gris una única vez: esa imagen
+    sirve para la caja de recorte y para los % de negro/blanco
+    (calculados para todo el lote de golpe), la textura, la nitidez y el
+    pHash.
+
+    Con ``complete`` se calculan todas las métricas aunque un filtro
+    barato ya descarte el frame (lo usa la ingesta al subir la imagen).
+
+    Devuelve, por frame, el dict de métricas más ``fresh`` (hay que
+    guardarlas), ``mini`` (miniatura en color) e ``img``.  El duplicado
+    por pHash se decide fuera, en orden, porque depende de los frames
+    anteriores.
+    """
+    out, pending = [None] * len(jobs), []
+    for i, (path, cached) in enumerate(jobs):
+        st = os.stat(path)
+        stamp = (st.st_size, st.st_mtime_ns)
+        verdict = _verdict(cached) if cached and not complete else None
+        if (verdict is not None and cached["stamp"] == stamp
+                and (verdict or not keep_full)):
+            # descartado, o pasa en streaming: ni se abre el fichero
+            out[i] = dict(cached, fresh=False, mini=None, img=None)
+            continue
 
-# ───── obtención + filtrado de frames ────────────────────────────────
-def _gather(sample):
-    raw = list(sample.images.filter(is_mosaic=False).order_by("id"))
-    useful, thumbs, hashes = [], [], set()
-    t0 = time.time()
+        with open(path, "rb") as fh:
+            data = fh.read()
+        checksum = hashlib.blake2b(data, digest_size=32).hexdigest()
+
+        if verdict is not None and cached["checksum"] == checksum:
+            # mismo contenido: solo hay que guardar el stat nuevo
+            m = dict(cached, stamp=stamp, fresh=cached["stamp"] != stamp,
+                     mini=None, img=None)
+            if not verdict and keep_full:
+                m["img"] = _apply_box(_decode(data), m["box"])
+            out[i] = m
+            continue
 
-    for simg in tqdm(raw, desc="Filtrando imágenes", unit="img"):
-        img = cv2.imread(simg.image.path)
-        img = _crop_circle_to_square(img)
-        mini = cv2.resize(img, None,
-                          fx=DOWNSCALE_FACTOR, fy=DOWNSCALE_FACTOR)
+        p = _prepare(data, keep_full)
+        p.update(i=i, checksum=checksum, stamp=stamp)
+        if keep_full and p["img"] is None:
+            p["data"] = data            # para decodificar solo si pasa
+        pending.append(p)
+
+    if not pending:
+        return out
+
+    black, white = _gray_ratios([p["gray"] for p in pending])
+    for p, b, w in zip(pending, black, white):
+        gray = p["gray"]
+        m = {"checksum": p["checksum"], "stamp": p["stamp"],
+             "box": p["box"], "fresh": True,
+             "black_ratio": float(b), "white_ratio": float(w),
+             "texture_score": None, "phash": None,
+             "sharpness": _texture_score(gray, "laplacian"),
+             "mini": p["mini"], "img": None}
+        if complete or _verdict(m) is None:  # no descartado por negro/blanco
+            m["texture_score"] = _texture_score(gray)
+            if (complete or _verdict(m) is None) and _USE_HASH:
+                m["phash"] = _phash(gray)
+        if keep_full and not _verdict(m):
+            m["img"] = (p["img"] if p["img"] is not None
+                        else _apply_box(_decode(p["data"]), p["box"]))
+        out[p["i"]] = m
+    return out
+
+def _analyze_frame(job, keep_full=True, complete=False):
+    return _analyze_batch([job], keep_full, complete)[0]
+
+def _analyze_frames(jobs, workers=None, keep_full=True, complete=False):
+    """Aplica ``_analyze_batch`` a ``jobs`` en lotes de FILTER_CHUNK y
+    devuelve las métricas una a una, conservando el orden.
+
+    Con ``workers`` > 1 reparte los lotes en un pool de procesos; con 1
+    (o un solo lote) se queda en el proceso actual.
+    """
+    fn = partial(_analyze_batch, keep_full=keep_full, complete=complete)
+    batches = [jobs[i:i + FILTER_CHUNK]
+               for i in range(0, len(jobs), FILTER_CHUNK)]
+    workers = FILTER_WORKERS if workers is None else workers
+    workers = min(workers, len(batches))
+    if workers <= 1:
+        for batch in map(fn, batches):
+            yield from batch
+        return
 
-        # filtros rápidos
-        if _mostly_black(mini) or _mostly_white(mini) or _too_few_features(mini):
-            continue
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_filter_worker) as pool:
+        for batch in pool.map(fn, batches):
+            yield from batch
 
-        if _USE_HASH:
-            phash = imagehash.phash(Image.fromarray(
-                cv2.cvtColor(mini, cv2.COLOR_BGR2RGB)))
-            if _is_duplicate(phash, hashes):
-                continue
-            hashes.add(phash)
+# ───── obtención + filtrado de frames ────────────────────────────────
+def _gather(sample, workers=None, progress=None, stream=None):
+    """Filtra los frames de ``sample``.
+
+    Devuelve las teselas ya igualadas de tamaño o, con ``stream``, una
+    lista de referencias ``(ruta, caja)`` que ``_grid_mosaic_stream``
+    releerá de una en una; y, en paralelo, el origen ``(id, caja)`` de
+    cada tesela para ``_grid_layout``.
+
+    ``progress(scanned, kept, total)`` se llama tras cada frame; si no se
+    pasa, se muestra una barra tqdm en consola.
+    """
+    stream = STREAM_MOSAIC if stream is None else stream
+    params = _feature_params()
+    # ``__in`` y no ``=False``: en SQLite ``NOT is_mosaic`` no es una
+    # igualdad y el índice (sample, is_mosaic, id) no serviría para ordenar
+    frames = sample.images.filter(is_mosaic__in=[False])
+    total = frames.count()
+    if TRUST_FEATURES:
+        # los ya descartados por la caché ni se abren
+        frames = frames.exclude(rejected_frames_q(params))
+    raw = list(frames.select_related("features").order_by("id"))
+    jobs = [(simg.image.path, _cached_metrics(simg, params)) for simg in raw]
+    useful, sources, thumbs, hashes = [], [], [], HammingIndex()
+    t0 = time.time()
 
-        useful.append(img)      # resolución completa
-        thumbs.append(mini)     # miniatura para depuración
+    results = _analyze_frames(jobs, workers, keep_full=not stream)
+    if progress is None:
+        results = tqdm(results, total=len(raw),
+                       desc="Filtrando imágenes", unit="img")
+    for scanned, (simg, m) in enumerate(zip(raw, results), 1):
+        if m["fresh"]:
+            _store_metrics(simg, m, params)
+
+        if not _verdict(m):
+            phash = phash_to_int(m["phash"]) if _USE_HASH else None
+            if not (_USE_HASH and _is_duplicate(phash, hashes)):
+                if _USE_HASH:
+                    hashes.add(phash, simg.id)
+                # resolución completa (en streaming, solo la referencia)
+                useful.append((simg.image.path, m["box"]) if stream
+                              else m["img"])
+                sources.append((simg.id, m["box"]))
+                # miniatura para depuración
+                thumbs.append(m["mini"] if m["mini"] is not None
+                              or not DEBUG_MOSAIC else _cached_thumb(simg))
+
+        if progress is not None:
+            # los descartados por SQL cuentan como ya revisados
+            progress(total - len(raw) + scanned, len(useful), total)
 
     # límite de teselas
     if MAX_FRAMES and len(useful) > MAX_FRAMES:
         keep = random.sample(range(len(useful)), MAX_FRAMES)
         useful = [useful[i] for i in keep]
+        sources = [sources[i] for i in keep]
         thumbs = [thumbs[i] for i in keep]
 
     # ——— NUEVO: igualar tamaños antes de devolver ———
-    useful = _standardize_tiles(useful)
+    if not stream:
+        useful = _standardize_tiles(useful)
 
-    print(f"Quedan {len(useful)}/{len(raw)} útiles ({time.time() - t0:.1f}s)")
+    print(f"Quedan {len(useful)}/{total} útiles ({time.time() - t0:.1f}s)")
     _save_thumbgrid(thumbs, sample)
-    return useful
+    return useful, sources
 
 # ───── montaje en cuadrícula ─────────────────────────────────────────
+def _new_canvas(shape):
+    """Lienzo a cero, en RAM o mapeado a un temporal de MOSAIC_MEMMAP_DIR."""
+    if MOSAIC_MEMMAP_DIR is None:
+        return np.zeros(shape, dtype=np.uint8)
+    tmp = tempfile.TemporaryFile(dir=MOSAIC_MEMMAP_DIR)
+    return np.memmap(tmp, dtype=np.uint8, mode="w+", shape=shape)
+
+class NoFramesError(RuntimeError):
+    """No queda ningún frame que montar: reintentar no cambia nada."""
+
+
+def _grid_shape(n):
+    cols = math.ceil(math.sqrt(n))
+    rows = math.ceil(n / cols)
+    return rows, cols
+
 def _grid_mosaic(imgs):
     if not imgs:
-        raise RuntimeError("No hay teselas que montar")
+        raise NoFramesError("No hay teselas que montar")
 
     h, w = imgs[0].shape[:2]
-    cols = math.ceil(math.sqrt(len(imgs)))
-    rows = math.ceil(len(imgs) / cols)
+    rows, cols = _grid_shape(len(imgs))
 
-    canvas = np.zeros((rows * h, cols * w, 3), dtype=np.uint8)
+    canvas = _new_canvas((rows * h, cols * w, 3))
     for idx, im in enumerate(imgs):
         r, c = divmod(idx, cols)
         y0, x0 = r * h, c * w
         canvas[y0:y0 + h, x0:x0 + w] = im
     return canvas
 
+def _grid_mosaic_stream(refs):
+    """Como ``_grid_mosaic``, pero relee cada frame ``(ruta, caja)`` y lo
+    escribe directamente en el lienzo ya reservado."""
+    if not refs:
+        raise NoFramesError("No hay teselas que montar")
+
+    shapes = [_box_shape(box) for _, box in refs]
+    h = min(sh[0] for sh in shapes)
+    w = min(sh[1] for sh in shapes)
+    rows, cols = _grid_shape(len(refs))
+
+    canvas = _new_canvas((rows * h, cols * w, 3))
+    for idx, (path, box) in enumerate(refs):
+        r, c = divmod(idx, cols)
+        y0, x0 = r * h, c * w
+        frame = cv2.imread(path)
+        if frame is None:   # borrado o cambiado entre las dos pasadas
+            raise OSError(f"No se pudo releer {path}")
+        tile = _apply_box(frame, box)
+        canvas[y0:y0 + h, x0:x0 + w] = _center_crop(tile, h, w)
+    return canvas
+
+def _grid_layout(sources, canvas):
+    """Qué frame ocupa cada celda del lienzo y dónde cae en el original.
+
+    ``frames[i] = [id, ox, oy]``: el píxel ``(x, y)`` de la celda ``i``
+    es el ``(x + ox, y + oy)`` del frame (recorte + borde + centrado).
+    """
+    rows, cols = _grid_shape(len(sources))
+    h, w = canvas.shape[0] // rows, canvas.shape[1] // cols
+    frames = []
+    for image_id, box in sources:
+        th, tw = _box_shape(box)
+        frames.append([str(image_id),
+                       int(box[0]) - BORDER_PX + (tw - w) // 2,
+                       int(box[1]) - BORDER_PX + (th - h) // 2])
+    return {"cell": [w, h], "cols": cols, "frames": frames}
+
 # ───── API pública ──────────────────────────────────────────────────
-def stitch_cropped(sample):
-    imgs = _gather(sample)
+def stitch_with_layout(sample, workers=None, progress=None, stream=None):
+    """Como ``stitch_cropped``; devuelve ``(lienzo, disposición)``."""
+    stream = STREAM_MOSAIC if stream is None else stream
+    imgs, sources = _gather(sample, workers, progress, stream)
     if not imgs:
-        raise RuntimeError("No hay imágenes válidas")
+        raise NoFramesError("No hay imágenes válidas")
 
     print("→ Construyendo mosaico cuadrícula…")
-    return _grid_mosaic(imgs)
+    canvas = _grid_mosaic_stream(imgs) if stream else _grid_mosaic(imgs)
+    return canvas, _grid_layout(sources, canvas)
+
+def stitch_cropped(sample, workers=None, progress=None, stream=None):
+    return stitch_with_layout(sample, workers, progress, stream)[0]
 
 # compatibilidad
 stitch_circular = stitch_cropped
 
+def frame_phash(path):
+    """pHash (hex) de un frame, calculado igual que en el filtrado."""
+    return _phash(_gray_mini(path))
+
 # ───── guardar JPEG (≈ 1-2 MB, calidad 95 %) ─────────────────────────
-def save_mosaic(sample, cv_img, suffix):
-    rgb = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB)
+def save_mosaic(sample, cv_img, suffix, layout=None):
+    # BGR→RGB in situ y sin copia para PIL: no duplica el lienzo en RAM
+    cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB, dst=cv_img)
+    h, w = cv_img.shape[:2]
     buf = BytesIO()
-    Image.fromarray(rgb).save(buf, "JPEG", quality=95)
-    return sample.images.create(
-        is_mosaic=True,
-        image=ContentFile(buf.getvalue(),
-                          name=f"{sample.id}_{suffix}.jpg")
-    )
+    try:
+        Image.frombuffer("RGB", (w, h), cv_img, "raw", "RGB", 0, 1)\
+             .save(buf, "JPEG", quality=95)
+    finally:
+        cv2.cvtColor(cv_img, cv2.COLOR_RGB2BGR, dst=cv_img)
+    # las teselas antes del INSERT y fuera de toda transacción (en SQLite
+    # tardarían minutos con el cerrojo de escritura tomado); la fila solo
+    # aparece con la pirámide completa
+    mosaic_id = uuid.uuid4()
+    if MOSAIC_TILES:
+        save_dzi(cv_img, str(mosaic_id))
+    try:
+        return sample.images.create(
+            id=mosaic_id,
+            is_mosaic=True,
+            mosaic_layout=layout,
+            image=ContentFile(buf.getvalue(),
+                              name=f"{sample.id}_{suffix}.jpg")
+        )
+    except Exception:
+        remove_dzi(str(mosaic_id))
+        raise
 # ─────────────────────────────────────────────────────────────────────
@@ -0,0 +1,205 @@
+# ───────────────────────── utils_storage.py ──────────────────────────
+"""
+Almacén direccionado por contenido para los ficheros de ``SampleImage``.
+
+ • El nombre de cada original es su BLAKE2b-256 (el mismo que
+   ``FrameFeatures.checksum``), repartido en dos niveles de carpetas:
+   ``images/ab/cd/abcd….jpg`` ⇒ ninguna carpeta pasa de unos pocos miles
+   de ficheros aunque haya millones de imágenes.
+ • Contenido repetido (reintentos, re-subidas) = mismo nombre: el fichero
+   se escribe una sola vez y todas las filas lo comparten.
+ • Un original compartido no se borra nunca en línea (``delete`` no hace
+   nada con estos nombres): entre comprobar que nadie lo usa y borrarlo
+   otra subida podría reutilizarlo. Los borra ``collect_garbage``
+   (``manage.py gc_media``): solo los que no tiene ninguna
+   ``SampleImage`` (el recuento de referencias es la propia tabla) y no
+   se han usado en CAS_GRACE_S; reutilizar un fichero actualiza su mtime.
+ • Solo se direccionan los nombres que genera ``upload_to``
+   (``images/<uuid>.<ext>``); miniaturas y demás derivados conservan el
+   nombre pedido, junto a su original.
+ • ``manage.py convert_media_storage`` pasa los ficheros antiguos (carpeta
+   plana) a este esquema.
+
+"""
+
+import glob
+import hashlib
+import os
+import re
+import time
+import uuid
+
+from django.apps import apps
+from django.core.files.storage import FileSystemStorage
+
+CAS_DIR     = "images"
+CAS_CHUNK   = 256 * 1024
+CAS_GRACE_S = 24 * 3600     # sin referencias ni uso en este tiempo → GC
+# images/ab/cd/abcd<60 hex>.<ext>
+CAS_NAME    = re.compile(r"^images/([0-9a-f]{2})/([0-9a-f]{2})/\1\2[0-9a-f]{60}\.\w+$")
+# lo que devuelve SampleImage.sample_image_upload_to: images/<uuid>.<ext>
+UPLOAD_NAME = re.compile(r"^images/[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}\.\w+$")
+
+
+def content_name(digest, ext):
+    return f"{CAS_DIR}/{digest[:2]}/{digest[2:4]}/{digest}.{ext.lower()}"
+
+
+def file_digest(fh):
+    """BLAKE2b-256 (hex) de un fichero abierto, desde el principio."""
+    h = hashlib.blake2b(digest_size=32)
+    fh.seek(0)
+    while chunk := fh.read(CAS_CHUNK):
+        h.update(chunk)
+    return h.hexdigest()
+
+
+class ContentAddressedStorage(FileSystemStorage):
+
+    def is_content_addressed(self, name):
+        return bool(CAS_NAME.match(name.replace("\\", "/")))
+
+    def get_available_name(self, name, max_length=None):
+        # el nombre definitivo lo decide el contenido, en _save
+        if UPLOAD_NAME.match(name):
+            return name
+        return super().get_available_name(name, max_length)
+
+    def _save(self, name, content):
+        if not UPLOAD_NAME.match(name):
+            return super()._save(name, content)
+
+        # una sola pasada: se escribe a un temporal mientras se calcula el
+        # hash y luego se enlaza en su sitio (rename atómico, sin carreras)
+        ext = os.path.splitext(name)[1].lstrip(".") or "bin"
+        incoming = self.path(os.path.join(CAS_DIR, ".incoming"))
+        os.makedirs(incoming, exist_ok=True)
+        h = hashlib.blake2b(digest_size=32)
+        tmp = os.path.join(incoming, f"{uuid.uuid4().hex}.part")
+        # 0o666 como FileSystemStorage: el umask decide los permisos finales
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL
+                     | getattr(os, "O_BINARY", 0), 0o666)
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                for chunk in content.chunks(CAS_CHUNK):
+                    h.update(chunk)
+                    fh.write(chunk)
+            name = content_name(h.hexdigest(), ext)
+            self.link(tmp, name)
+        finally:
+            os.remove(tmp)
+        return name
+
+    def link(self, src, name):
+        """Enlaza ``src`` como ``name``; si ya existe, es el mismo fichero
+        (devuelve ``False``) y se marca como usado ahora para el GC."""
+        full = self.path(name)
+        os.makedirs(os.path.dirname(full), exist_ok=True,
+                    mode=self.directory_permissions_mode or 0o777)
+        while True:
+            try:
+                os.link(src, full)
+            except FileExistsError:
+                try:
+                    # el mtime compartido invalida el stat guardado en
+                    # FrameFeatures: solo cuesta rehashear ese frame
+                    os.utime(full)
+                except FileNotFoundError:
+                    continue    # el GC lo acaba de retirar: se re-enlaza
+                return False
+            break
+        if self.file_permissions_mode is not None:
+            os.chmod(full, self.file_permissions_mode)
+        return True
+
+    def references(self, name):
+        SampleImage = apps.get_model("iaweb", "SampleImage")
+        return SampleImage.objects.filter(image=name).exists()
+
+    def delete(self, name):
+        if self.is_content_addressed(name):
+            return              # compartido: lo decide collect_garbage
+        super().delete(name)
+
+    def _retire(self, name, cutoff):
+        """Borra ``name`` (y sus derivados) si sigue sin usarse.
+
+        Primero se aparta con un ``rename`` atómico y luego se vuelve a
+        comprobar: una subida que lo reutiliza a la vez o ya lo ha
+        tocado (se restaura) o no lo encuentra y lo vuelve a enlazar.
+        """
+        full = self.path(name)
+        retired = f"{full}.gc"
+        try:
+            os.rename(full, retired)
+        except FileNotFoundError:
+            return 0
+        st = os.stat(retired)
+        if st.st_mtime >= cutoff or self.references(name):
+            _restore(retired, full)
+            return 0
+        os.remove(retired)
+        # miniaturas y demás derivados: <hash>_<sufijo>.<ext>
+        stem = os.path.splitext(full)[0]
+        for derived in glob.glob(f"{glob.escape(stem)}_*"):
+            os.remove(derived)
+        return st.st_size
+
+
+def _restore(retired, full):
+    try:
+        os.link(retired, full)
+    except FileExistsError:
+        pass                    # una subida ya lo ha vuelto a enlazar
+    os.remove(retired)
+
+
+_storage = ContentAddressedStorage()
+
+
+def collect_garbage(storage=None, grace=CAS_GRACE_S, dry_run=False):
+    """Borra los originales sin ninguna ``SampleImage`` que no se han usado
+    en ``grace`` segundos (con sus miniaturas) y los temporales de
+    subidas cortadas. Devuelve ``(ficheros, bytes)``.
+    """
+    storage = storage or _storage
+    SampleImage = apps.get_model("iaweb", "SampleImage")
+    # una sola consulta; cada candidato se vuelve a comprobar al borrarlo
+    referenced = set(SampleImage.objects.values_list("image", flat=True)
+                     .iterator(chunk_size=10000))
+    cutoff = time.time() - grace
+    removed = freed = 0
+    root = storage.path(CAS_DIR)
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            full = os.path.join(dirpath, filename)
+            name = os.path.relpath(full, storage.location).replace(os.sep, "/")
+            if filename.endswith(".gc"):
+                # GC cortado a medias: se restaura y se decide otro día
+                if not dry_run:
+                    _restore(full, full[:-len(".gc")])
+                continue
+            try:
+                st = os.stat(full)
+            except FileNotFoundError:
+                continue
+            incoming = os.path.basename(dirpath) == ".incoming"
+            if st.st_mtime >= cutoff or not (
+                    incoming or storage.is_content_addressed(name)
+                    and name not in referenced):
+                continue
+            size = st.st_size
+            if dry_run:
+                pass
+            elif incoming:
+                os.remove(full)
+            elif not storage._retire(name, cutoff):
+                continue
+            removed, freed = removed + 1, freed + size
+    return removed, freed
+
+
+def sample_image_storage():
+    """Storage de ``SampleImage.image`` (callable: las migraciones guardan
+    la referencia, no la configuración)."""
+    return _storage
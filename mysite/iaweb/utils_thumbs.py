@@ -0,0 +1,72 @@
+# ───────────────────────── utils_thumbs.py ───────────────────────────
+"""
+Miniaturas de tamaño fijo para los listados del admin.
+
+ • Se guardan junto al original: ``images/<nombre>_<tamaño>.webp``
+   (JPEG si Pillow no trae WebP).
+ • Se crean en la ingesta (``utils_ingest``) o, si faltan, la primera
+   vez que se piden a ``views.thumbnail``.
+ • La URL lleva ``?v=`` con un hash corto del nombre del fichero: el
+   original no cambia tras subirlo, pero la imagen con detecciones se
+   regenera con otro nombre, así que la URL (y el ETag) cambian con ella
+   y la caché larga no sirve miniaturas viejas.
+
+"""
+
+import hashlib
+import os
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.urls import reverse
+from PIL import Image, ImageOps, features
+
+THUMB_SIZES = {             # lado mayor (px); ×2 para pantallas retina
+    "s": 128,
+    "m": 320,
+}
+THUMB_QUALITY = 80
+THUMB_FIELDS = {            # segmento de la URL → campo de SampleImage
+    "image": "image",
+    "detected": "detected_image",
+}
+
+THUMB_FORMAT = "WEBP" if features.check("webp") else "JPEG"
+THUMB_EXT = "webp" if THUMB_FORMAT == "WEBP" else "jpg"
+THUMB_CONTENT_TYPE = f"image/{THUMB_EXT.replace('jpg', 'jpeg')}"
+
+
+def thumbnail_name(field_file, size):
+    stem = os.path.splitext(field_file.name)[0]
+    return f"{stem}_{size}.{THUMB_EXT}"
+
+
+def ensure_thumbnail(field_file, size="s"):
+    """Crea (si no existe) la miniatura de ``field_file`` y devuelve su
+    nombre en el storage."""
+    storage = field_file.storage
+    name = thumbnail_name(field_file, size)
+    if storage.exists(name):
+        return name
+
+    side = THUMB_SIZES[size]
+    with field_file.open("rb") as fh, Image.open(fh) as im:
+        im.draft("RGB", (side, side))   # JPEG: decodifica ya reducido
+        im = ImageOps.exif_transpose(im).convert("RGB")
+        im.thumbnail((side, side))
+        buf = BytesIO()
+        im.save(buf, THUMB_FORMAT, quality=THUMB_QUALITY)
+    return storage.save(name, ContentFile(buf.getvalue()))
+
+
+def thumbnail_version(field_file):
+    """Hash corto del nombre del fichero: cambia si se sustituye."""
+    return hashlib.blake2b(field_file.name.encode(),
+                           digest_size=6).hexdigest()
+
+
+def thumbnail_url(image, size="s", field="image"):
+    """URL cacheable de la miniatura de ``image.<field>``."""
+    url = reverse("Thumbnail", args=[field, image.pk, size])
+    field_file = getattr(image, THUMB_FIELDS[field])
+    return f"{url}?v={thumbnail_version(field_file)}" if field_file else url
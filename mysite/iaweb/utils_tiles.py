@@ -0,0 +1,140 @@
+# ───────────────────────── utils_tiles.py ────────────────────────────
+"""
+Pirámide de teselas tipo Deep Zoom (DZI) a partir del lienzo del mosaico.
+
+ • Nivel ``max`` = lienzo original; cada nivel inferior es la mitad,
+   hasta 1×1 px (convención DZI).
+ • Cada nivel se corta en teselas de TILE_SIZE px (+ TILE_OVERLAP) y se
+   guardan como ``<MEDIA_ROOT>/mosaics/<id>_files/<nivel>/<col>_<fila>.jpg``
+   junto al descriptor ``<id>.dzi``.
+ • Los visores (OpenSeadragon, …) solo piden las teselas que se ven;
+   ``views.mosaic_tile`` las sirve con cabeceras de caché.
+ • ``DziImage`` lee regiones del nivel máximo tesela a tesela: permite
+   recorrer mosaicos enormes sin decodificarlos enteros (detección).
+
+"""
+
+import math
+import os
+import re
+import shutil
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+TILE_SIZE    = 256          # lado de cada tesela (px)
+TILE_OVERLAP = 1            # solape con las vecinas (px, estándar DZI)
+TILE_FORMAT  = "jpg"
+TILE_QUALITY = 85           # calidad JPEG de las teselas
+
+_DZI_XML = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+            'TileSize="{tile}" Overlap="{overlap}" Format="{fmt}">'
+            '<Size Width="{w}" Height="{h}"/></Image>\n')
+
+
+def tiles_root():
+    return os.path.join(settings.MEDIA_ROOT, "mosaics")
+
+
+def dzi_path(name):
+    return os.path.join(tiles_root(), f"{name}.dzi")
+
+
+def tile_path(name, level, col, row):
+    return os.path.join(tiles_root(), f"{name}_files", str(level),
+                        f"{col}_{row}.{TILE_FORMAT}")
+
+
+def _write_level(img, level_dir):
+    os.makedirs(level_dir, exist_ok=True)
+    h, w = img.shape[:2]
+    params = [cv2.IMWRITE_JPEG_QUALITY, TILE_QUALITY]
+    for row in range(math.ceil(h / TILE_SIZE)):
+        for col in range(math.ceil(w / TILE_SIZE)):
+            x0 = max(0, col * TILE_SIZE - TILE_OVERLAP)
+            y0 = max(0, row * TILE_SIZE - TILE_OVERLAP)
+            x1 = min(w, (col + 1) * TILE_SIZE + TILE_OVERLAP)
+            y1 = min(h, (row + 1) * TILE_SIZE + TILE_OVERLAP)
+            ok, enc = cv2.imencode(f".{TILE_FORMAT}", img[y0:y1, x0:x1],
+                                   params)
+            with open(os.path.join(level_dir, f"{col}_{row}.{TILE_FORMAT}"),
+                      "wb") as fh:
+                fh.write(enc.tobytes())
+
+
+def save_dzi(canvas, name):
+    """Genera la pirámide DZI de ``canvas`` (BGR) con nombre ``name``.
+
+    Solo hay en memoria un nivel reducido a la vez (≤ ¼ del lienzo); el
+    nivel máximo se corta directamente del lienzo (vale un ``memmap``).
+    Devuelve la ruta del ``.dzi``.
+    """
+    h, w = canvas.shape[:2]
+    max_level = math.ceil(math.log2(max(w, h, 1)))
+    files_dir = os.path.join(tiles_root(), f"{name}_files")
+    shutil.rmtree(files_dir, ignore_errors=True)
+
+    img = canvas
+    for level in range(max_level, -1, -1):
+        _write_level(img, os.path.join(files_dir, str(level)))
+        if level:
+            lh, lw = img.shape[:2]
+            img = cv2.resize(img, (math.ceil(lw / 2), math.ceil(lh / 2)),
+                             interpolation=cv2.INTER_AREA)
+
+    # el descriptor al final: si existe, la pirámide está completa
+    path = dzi_path(name)
+    with open(path, "w", encoding="utf-8") as fh:
+        fh.write(_DZI_XML.format(tile=TILE_SIZE, overlap=TILE_OVERLAP,
+                                 fmt=TILE_FORMAT, w=w, h=h))
+    return path
+
+
+def remove_dzi(name):
+    """Borra la pirámide ``name`` (descriptor primero: deja de estar
+    completa antes de perder teselas)."""
+    try:
+        os.remove(dzi_path(name))
+    except FileNotFoundError:
+        pass
+    shutil.rmtree(os.path.join(tiles_root(), f"{name}_files"),
+                  ignore_errors=True)
+
+
+class DziImage:
+    """Vista de solo lectura del nivel máximo de una pirámide DZI.
+
+    Admite ``shape`` y ``img[y0:y1, x0:x1]`` como un array BGR; cada
+    recorte lee solo las teselas que toca.
+    """
+
+    def __init__(self, name):
+        with open(dzi_path(name), encoding="utf-8") as fh:
+            xml = fh.read()
+        w = int(re.search(r'Width="(\d+)"', xml).group(1))
+        h = int(re.search(r'Height="(\d+)"', xml).group(1))
+        self.name = name
+        self.shape = (h, w, 3)
+        self.level = math.ceil(math.log2(max(w, h, 1)))
+
+    def __getitem__(self, key):
+        ys, xs = key
+        y0, y1, _ = ys.indices(self.shape[0])
+        x0, x1, _ = xs.indices(self.shape[1])
+        out = np.zeros((max(y1 - y0, 0), max(x1 - x0, 0), 3), np.uint8)
+        for row in range(y0 // TILE_SIZE, math.ceil(y1 / TILE_SIZE)):
+            for col in range(x0 // TILE_SIZE, math.ceil(x1 / TILE_SIZE)):
+                tile = cv2.imread(tile_path(self.name, self.level, col, row))
+                if tile is None:
+                    continue
+                # origen de la tesela (con solape salvo en el borde)
+                tx = max(0, col * TILE_SIZE - TILE_OVERLAP)
+                ty = max(0, row * TILE_SIZE - TILE_OVERLAP)
+                ax, ay = max(x0, tx), max(y0, ty)
+                bx = min(x1, tx + tile.shape[1])
+                by = min(y1, ty + tile.shape[0])
+                out[ay - y0:by - y0, ax - x0:bx - x0] = \
+                    tile[ay - ty:by - ty, ax - tx:bx - tx]
+        return out
@@ -0,0 +1,494 @@
+# ───────────────────────── utils_upload.py ───────────────────────────
+"""
+Ingesta de sub-imágenes sin pasar por el serializer una a una.
+
+ • ``iter_multipart`` / ``iter_tar`` / ``iter_zip`` convierten el cuerpo
+   de la petición en pares ``(nombre, fichero)``; cada frame se vuelca a
+   un temporal (en disco si es grande), nunca el cuerpo entero a RAM.
+ • ``bulk_ingest`` valida la cabecera de cada imagen, la guarda en el
+   storage y crea todas las filas ``SampleImage`` con un único
+   ``bulk_create`` dentro de una transacción.
+ • ``BinaryImageParser`` / ``RawImageParser``: subida de una sola imagen
+   como cuerpo binario (``application/octet-stream`` o ``image/*``), en
+   trozos a disco con los upload handlers de Django. ``base64_upload``
+   es el camino antiguo (JSON con data-URL), que sigue funcionando.
+ • ``astore_frame``: lo mismo que ``store_frame`` para las vistas
+   asíncronas; la escritura va a un hilo del pool por defecto y el
+   bucle de eventos sigue atendiendo otras conexiones.
+ • ``RequestSizeLimit`` (envuelve la aplicación en ``mysite.asgi``):
+   el ``ASGIHandler`` de Django vuelca el cuerpo entero a un temporal
+   antes de llamar a la vista, así que el 413 se decide antes, con el
+   ``Content-Length`` o contando los bytes según llegan.
+ • Subida reanudable (``UploadSession``): ``open_session`` declara
+   tamaño + checksum, ``append_chunk`` añade bytes en el offset actual y,
+   al completar, verifica el checksum y crea la ``SampleImage`` una sola
+   vez. Una conexión cortada conserva lo recibido hasta el corte.
+   Cada trozo reserva la sesión con un ``UPDATE`` condicional (offset +
+   ``locked_until``), que serializa también en SQLite, donde
+   ``select_for_update`` no bloquea nada.
+
+"""
+
+import base64
+import binascii
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image, UnidentifiedImageError
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import DataAndFiles, FileUploadParser
+
+from .models import SampleImage, UploadSession
+from .utils_cache import bump_sample_list
+from .utils_ingest import schedule_ingest
+from .utils_storage import content_name
+
+ALLOWED_FORMATS = {"JPEG": "jpg", "PNG": "png", "TIFF": "tif",
+                   "BMP": "bmp", "WEBP": "webp"}
+COPY_CHUNK = 256 * 1024
+UPLOAD_MAX_SIZE = 200 * 1024 * 1024    # tamaño máximo de una subida reanudable
+UPLOAD_LOCK_S = 600                    # reserva máx. de un trozo en curso
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+log = logging.getLogger(__name__)
+
+
+def spool(src):
+    """Copia ``src`` (stream) a un temporal que pasa a disco si es grande."""
+    tmp = tempfile.SpooledTemporaryFile(
+        max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+    shutil.copyfileobj(src, tmp, COPY_CHUNK)
+    tmp.seek(0)
+    return tmp
+
+
+def image_extension(fileobj):
+    """Extensión según la cabecera de la imagen, sin decodificar píxeles.
+
+    Lanza ``ValidationError`` si no es una imagen de un formato admitido.
+    """
+    pos = fileobj.tell()
+    try:
+        with Image.open(fileobj) as im:
+            fmt = im.format
+    except (UnidentifiedImageError, OSError):
+        raise ValidationError("Not a valid image file.")
+    finally:
+        fileobj.seek(pos)
+    if fmt not in ALLOWED_FORMATS:
+        raise ValidationError(f"Unsupported image format: {fmt}.")
+    return ALLOWED_FORMATS[fmt]
+
+
+# ───── subida de una imagen ──────────────────────────────────────────
+class BinaryImageParser(FileUploadParser):
+    """El cuerpo es la imagen. El resto de campos (``sample``) van en la
+    query string; el nombre, opcional, en ``Content-Disposition``."""
+    media_type = "application/octet-stream"
+
+    def get_filename(self, stream, media_type, parser_context):
+        return super().get_filename(stream, media_type, parser_context) \
+            or "upload"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        upload = super().parse(stream, media_type, parser_context).files["file"]
+        try:
+            ext = image_extension(upload)
+        except ValidationError as exc:
+            upload.close()
+            raise ParseError(" ".join(exc.messages))
+        stem = os.path.splitext(os.path.basename(upload.name))[0] or "upload"
+        upload.name = f"{stem}.{ext}"
+        data = parser_context["request"].query_params.copy()
+        return DataAndFiles(data, {"image": upload})
+
+
+class RawImageParser(BinaryImageParser):
+    media_type = "image/*"
+
+
+def base64_upload(data_url):
+    """Decodifica una data-URL ``data:image/<ext>;base64,...`` a un temporal
+    en disco, por trozos, sin copiar la imagen entera en memoria."""
+    header, _, payload = data_url.partition(";base64,")
+    ext = header.split("/")[-1]
+    if _WHITESPACE_RE.search(payload):
+        # base64 partido en líneas (en cualquier punto, no solo al principio)
+        payload = _WHITESPACE_RE.sub("", payload)
+
+    step = COPY_CHUNK // 3 * 4                 # múltiplo de 4 caracteres
+    tmp = TemporaryUploadedFile(f"temp.{ext}", f"image/{ext}", 0, None)
+    try:
+        for i in range(0, len(payload), step):
+            # validate: un carácter extraño es un error, no se descarta
+            tmp.write(base64.b64decode(payload[i:i + step], validate=True))
+    except (binascii.Error, ValueError):
+        tmp.close()
+        raise ValidationError("Invalid base64 image.")
+    tmp.size = tmp.tell()
+    tmp.seek(0)
+    return tmp
+
+
+# ───── lectores del cuerpo de la petición ────────────────────────────
+def iter_multipart(files):
+    for f in files:
+        yield f.name, f
+
+
+def iter_tar(stream):
+    """Lee un tar (opcionalmente comprimido) en modo stream, sin seek."""
+    with tarfile.open(fileobj=stream, mode="r|*") as tar:
+        for member in tar:
+            if member.isfile():
+                yield member.name, spool(tar.extractfile(member))
+
+
+def iter_zip(stream):
+    """Los zip necesitan seek: el cuerpo se vuelca antes a un temporal."""
+    with spool(stream) as tmp, zipfile.ZipFile(tmp) as zf:
+        for info in zf.infolist():
+            if not info.is_dir():
+                with zf.open(info) as member:
+                    yield info.filename, spool(member)
+
+
+# ───── guardado + inserción en bloque ────────────────────────────────
+def store_frame(sample, fileobj):
+    """Guarda el fichero en el storage y devuelve la ``SampleImage`` sin
+    insertar todavía."""
+    ext = image_extension(fileobj)
+    simg = SampleImage(sample=sample)
+    field = simg.image.field
+    target = field.generate_filename(simg, f"upload.{ext}")
+    simg.image.name = field.storage.save(target, File(fileobj, name=target))
+    return simg
+
+
+def _seekable(fileobj):
+    try:
+        return fileobj.seekable()
+    except (AttributeError, ValueError):
+        return False
+
+
+async def astore_frame(sample, stream):
+    """``store_frame`` desde código asíncrono.
+
+    Con una petición ASGI el cuerpo ya está en el temporal del handler
+    (``request._stream``) y se usa tal cual; cualquier otro ``stream``
+    sin ``seek`` se vuelca antes a un temporal.
+    """
+    body = getattr(stream, "_stream", stream)
+
+    def store():
+        if _seekable(body):
+            body.seek(0)
+            return store_frame(sample, body)
+        with spool(stream) as tmp:
+            return store_frame(sample, tmp)
+    # thread_sensitive=False: las escrituras no esperan al hilo del ORM
+    return await sync_to_async(store, thread_sensitive=False)()
+
+
+class RequestSizeLimit:
+    """Middleware ASGI: responde 413 a los cuerpos que pasan del límite
+    de su ruta (``{nombre de URL: bytes}``) sin esperar a recibirlos.
+
+    Con ``Content-Length`` se decide antes de leer nada; sin él (cuerpo
+    por trozos) se cuentan los bytes y, al pasarse, Django recibe un
+    ``http.disconnect`` y deja de leer.
+    """
+
+    def __init__(self, app, limits=None):
+        self.app = app
+        self.limits = limits or {"ImageAsync": UPLOAD_MAX_SIZE}
+        self._paths = None
+
+    def _limit(self, path):
+        if self._paths is None:        # las URLs aún no existen al importar
+            self._paths = {reverse(name): size
+                           for name, size in self.limits.items()}
+        return self._paths.get(path)
+
+    async def __call__(self, scope, receive, send):
+        limit = self._limit(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            return await self.app(scope, receive, send)
+
+        length = dict(scope["headers"]).get(b"content-length")
+        try:
+            if length is not None and int(length) > limit:
+                return await self._too_large(send)
+        except ValueError:
+            pass                        # la vista responde 400
+
+        received, aborted, started = 0, False, False
+
+        async def limited_receive():
+            nonlocal received, aborted
+            if aborted:
+                return {"type": "http.disconnect"}
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    aborted = True
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def tracked_send(message):
+            nonlocal started
+            started = started or message["type"] == "http.response.start"
+            await send(message)
+
+        await self.app(scope, limited_receive, tracked_send)
+        if aborted and not started:
+            await self._too_large(send)
+
+    @staticmethod
+    async def _too_large(send):
+        body = b'{"error": "Image too large."}'
+        await send({"type": "http.response.start", "status": 413,
+                    "headers": [(b"content-type", b"application/json"),
+                                (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+
+def bulk_ingest(sample, frames):
+    """Ingesta ``frames`` (pares ``(nombre, fichero)``) de ``sample``.
+
+    Devuelve ``(creadas, errores)``: listas de dicts con ``name`` y ``id``
+    o ``error``, en el orden recibido.
+    """
+    pending, errors = [], []
+    try:
+        for name, fileobj in frames:
+            try:
+                pending.append((name, store_frame(sample, fileobj)))
+            except ValidationError as exc:
+                errors.append({"name": name, "error": " ".join(exc.messages)})
+            finally:
+                fileobj.close()
+
+        with transaction.atomic():
+            SampleImage.objects.bulk_create([simg for _, simg in pending])
+            # bulk_create no lanza post_save: ingesta y caché a mano
+            for _, simg in pending:
+                schedule_ingest(simg.id)
+            bump_sample_list()
+    except Exception:
+        # archivo corrupto a medias o fallo de la BD: no dejar huérfanos
+        for _, simg in pending:
+            simg.image.delete(save=False)
+        raise
+
+    created = [{"name": name, "id": str(simg.id)} for name, simg in pending]
+    return created, errors
+
+
+# ───── subida reanudable ─────────────────────────────────────────────
+_CHECKSUM_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+class OffsetMismatch(Exception):
+    """El trozo no empieza donde acabó el anterior (``offset`` = el bueno)."""
+
+    def __init__(self, offset):
+        super().__init__(f"Expected offset {offset}.")
+        self.offset = offset
+
+
+def file_checksum(fh):
+    """BLAKE2b-256 (hex) de un fichero abierto, el mismo que
+    ``FrameFeatures.checksum``."""
+    h = hashlib.blake2b(digest_size=32)
+    while chunk := fh.read(COPY_CHUNK):
+        h.update(chunk)
+    return h.hexdigest()
+
+
+def uploads_root():
+    return os.path.join(settings.MEDIA_ROOT, "uploads")
+
+
+def part_path(session):
+    return os.path.join(uploads_root(), f"{session.pk}.part")
+
+
+def open_session(sample, size, checksum, filename=""):
+    """Crea (o recupera, si ya existe) la sesión de subida de ``checksum``.
+
+    Devuelve ``(sesión, creada)``. Si el fichero ya estaba en la muestra
+    (ingestado por otro camino) la sesión nace completa; si estaba
+    completa pero su imagen se ha borrado, vuelve a empezar.
+    """
+    checksum = checksum.lower()
+    if not _CHECKSUM_RE.match(checksum):
+        raise ValidationError("Checksum must be a hex BLAKE2b-256 digest.")
+    if not 0 < size <= UPLOAD_MAX_SIZE:
+        raise ValidationError(f"Size must be between 1 and {UPLOAD_MAX_SIZE}.")
+
+    try:
+        with transaction.atomic():
+            session, created = UploadSession.objects.get_or_create(
+                sample=sample, checksum=checksum,
+                defaults={"size": size, "filename": filename})
+    except IntegrityError:      # otra petición la ha creado a la vez
+        session, created = UploadSession.objects.get(
+            sample=sample, checksum=checksum), False
+
+    if not created and session.size != size:
+        raise ValidationError("Size does not match the existing upload.")
+    if not created:
+        session = _restart_orphan(session)
+    if session.status == UploadSession.OPEN and session.offset == 0:
+        # el nombre en el storage es el propio checksum (utils_storage):
+        # vale aunque la ingesta aún no haya rellenado FrameFeatures
+        existing = (SampleImage.objects
+                    .filter(Q(image__startswith=content_name(checksum, ""))
+                            | Q(features__checksum=checksum), sample=sample)
+                    .only("id").first())
+        if existing:
+            session.status, session.offset = UploadSession.COMPLETE, size
+            session.image = existing
+            session.save(update_fields=["status", "offset", "image"])
+    return session, created
+
+
+def _restart_orphan(session):
+    """Una sesión completa cuya imagen se ha borrado vuelve a empezar."""
+    if session.status != UploadSession.COMPLETE or session.image_id:
+        return session
+    UploadSession.objects.filter(
+        pk=session.pk, status=UploadSession.COMPLETE,
+        image__isnull=True).update(status=UploadSession.OPEN, offset=0,
+                                   locked_until=None)
+    try:
+        os.remove(part_path(session))
+    except FileNotFoundError:
+        pass
+    session.refresh_from_db()
+    return session
+
+
+def _claim(session, offset):
+    """Reserva la sesión para escribir en ``offset``: un ``UPDATE``
+    condicional que solo gana una petición a la vez."""
+    now = timezone.now()
+    return UploadSession.objects.filter(
+        Q(locked_until__isnull=True) | Q(locked_until__lt=now),
+        pk=session.pk, status=UploadSession.OPEN, offset=offset,
+    ).update(locked_until=now + timedelta(seconds=UPLOAD_LOCK_S))
+
+
+def append_chunk(session, offset, stream):
+    """Escribe ``stream`` en ``offset`` y, si es el último trozo, crea la
+    imagen. Devuelve la sesión actualizada.
+
+    Lanza ``OffsetMismatch`` si ``offset`` no es el esperado (o si otro
+    trozo se está escribiendo) y ``ValidationError`` si el trozo se pasa
+    de tamaño o el fichero completo no cuadra con el checksum (la subida
+    vuelve a empezar).
+    """
+    session = _restart_orphan(
+        UploadSession.objects.select_related("sample").get(pk=session.pk))
+    if session.status == UploadSession.COMPLETE:
+        return session
+    if offset != session.offset or not _claim(session, offset):
+        # el cliente reintenta desde el offset que le devolvemos
+        raise OffsetMismatch(
+            UploadSession.objects.values_list("offset", flat=True)
+            .get(pk=session.pk))
+
+    try:
+        path = part_path(session)
+        os.makedirs(uploads_root(), exist_ok=True)
+        written = 0
+        with open(path, "r+b" if os.path.exists(path) else "wb") as fh:
+            fh.seek(offset)
+            fh.truncate()       # restos de un intento cortado a medias
+            try:
+                while chunk := stream.read(COPY_CHUNK):
+                    if offset + written + len(chunk) > session.size:
+                        fh.truncate(offset)
+                        raise ValidationError(
+                            "Chunk exceeds the declared upload size.")
+                    fh.write(chunk)
+                    written += len(chunk)
+            except OSError as exc:
+                # conexión cortada: se guarda lo recibido y se reanuda ahí
+                log.warning("Trozo cortado en la subida %s: %d bytes "
+                            "recibidos desde %d (%s)", session.pk, written,
+                            offset, exc)
+
+        session.offset = offset + written
+        session.save(update_fields=["offset", "date_updated"])
+        if session.offset == session.size:
+            error = _finish(session, path)
+            if error:
+                raise ValidationError(error)
+    finally:
+        UploadSession.objects.filter(pk=session.pk).update(locked_until=None)
+    return session
+
+
+def _finish(session, path):
+    """Verifica y crea la imagen; devuelve el error si hay que reiniciar."""
+    with open(path, "rb") as fh:
+        error = None
+        if file_checksum(fh) != session.checksum:
+            error = "Checksum mismatch, upload restarted."
+        else:
+            fh.seek(0)
+            try:
+                simg = store_frame(session.sample, fh)
+            except ValidationError as exc:
+                error = " ".join(exc.messages)
+    if error:
+        os.remove(path)
+        session.offset = 0
+        session.save(update_fields=["offset", "date_updated"])
+        return error
+
+    try:
+        simg.save()         # post_save ⇒ ingesta y detección, como siempre
+    except Exception:
+        simg.image.delete(save=False)
+        raise
+    session.status, session.image = UploadSession.COMPLETE, simg
+    session.save(update_fields=["status", "image", "date_updated"])
+    os.remove(path)
+    return None
+
+
+def purge_stale_uploads(before):
+    """Borra las sesiones abiertas sin actividad desde ``before``."""
+    stale = UploadSession.objects.filter(status=UploadSession.OPEN,
+                                         date_updated__lt=before)
+    n = 0
+    for session in stale.only("id"):
+        try:
+            os.remove(part_path(session))
+        except FileNotFoundError:
+            pass
+        session.delete()
+        n += 1
+    return n
@@ -1,26 +1,125 @@
-from django.http import HttpResponse
-from django.shortcuts import render
+import os
+import tarfile
+import zipfile
+from datetime import datetime, time
+from io import BytesIO
+
+from django.core.exceptions import ValidationError
+from django.db.models import Prefetch
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
+from django.shortcuts import get_object_or_404, render
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.utils.dateparse import parse_date, parse_datetime
+from django.views.decorators.cache import cache_control
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition, require_GET, require_POST
 from rest_framework import generics
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.decorators import api_view
-from .models import DiagnosisReport, SampleImage, Sample
-from .serializers import DiagnosisReportSerializer, SampleImageSerializer, SampleSerializer
+from rest_framework.decorators import api_view, parser_classes
+from rest_framework.pagination import CursorPagination
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+from .models import DiagnosisReport, SampleImage, Sample, UploadSession
+from .serializers import (DiagnosisReportSerializer, SampleImageSerializer,
+                          SampleSerializer, UploadSessionSerializer)
+from .utils_cache import (acached_sample_list, cached_sample_list,
+                          sample_list_etag, sample_list_modified)
+from .utils_thumbs import (THUMB_CONTENT_TYPE, THUMB_FIELDS, THUMB_SIZES,
+                           ensure_thumbnail, thumbnail_version)
+from .utils_tiles import dzi_path, tile_path
+from .utils_upload import (UPLOAD_MAX_SIZE, BinaryImageParser,
+                           OffsetMismatch, RawImageParser, append_chunk,
+                           astore_frame, bulk_ingest, iter_multipart,
+                           iter_tar, iter_zip, open_session)
+
+# JSON con base64 (antiguo), multipart o la imagen en bruto como cuerpo
+IMAGE_PARSERS = [JSONParser, FormParser, MultiPartParser,
+                 BinaryImageParser, RawImageParser]
+
+
+# ─── Listado de muestras ─────────────────────────────────────────
+# Dos consultas por petición (muestras + ids de sus imágenes) sea cual
+# sea el tamaño de página.
+class SampleCursorPagination(CursorPagination):
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+    ordering = ('-date_published', '-id')
+
+
+def sample_list_queryset(expand_images=True):
+    qs = Sample.objects.filter(available=True).only(
+        'id', 'patient', 'sample_type', 'date_published', 'available')
+    if expand_images:
+        qs = qs.prefetch_related(Prefetch(
+            'images', queryset=SampleImage.objects.only('id', 'sample')))
+    return qs
+
+
+def _parse_when(value, end=False):
+    """Fecha (``2024-05-01``, el día entero si ``end``) o fecha-hora ISO;
+    ``ValueError`` si no."""
+    when = parse_datetime(value)
+    if when is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(value)
+        when = datetime.combine(day, time.max if end else time.min)
+    if timezone.is_naive(when):
+        when = timezone.make_aware(when)
+    return when
+
+
+@api_view(['GET'])
+def list_samples(request):
+    """Muestras disponibles, paginadas por cursor.
+
+    Filtros: ``health_center`` (id), ``date_from`` / ``date_to`` (sobre
+    ``date_published``); ``images=0`` no incluye los ids de las imágenes.
+    """
+    expand = request.query_params.get('images', '1') not in ('0', 'false')
+    qs = sample_list_queryset(expand)
+    params = request.query_params
+    try:
+        if params.get('health_center'):
+            qs = qs.filter(health_center_id=int(params['health_center']))
+        if params.get('date_from'):
+            qs = qs.filter(date_published__gte=_parse_when(params['date_from']))
+        if params.get('date_to'):
+            qs = qs.filter(date_published__lte=_parse_when(params['date_to'],
+                                                          end=True))
+    except ValueError as exc:
+        return Response({'error': f'Invalid filter value: {exc}'},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    paginator = SampleCursorPagination()
+    page = paginator.paginate_queryset(qs, request)
+    serializer = SampleSerializer(page, many=True, expand_images=expand)
+    return paginator.get_paginated_response(serializer.data)
+
+
+def _sample_list_data():
+    return SampleSerializer(list(sample_list_queryset()), many=True).data
+
+
+# ETag / Last-Modified salen de la versión en caché: un sondeo sin
+# cambios recibe 304 sin consultar la base de datos (ver utils_cache).
+# Solo en el GET: en el PATCH los If-Match / If-Unmodified-Since se
+# compararían con el listado, no con la muestra que se modifica.
+@condition(etag_func=sample_list_etag, last_modified_func=sample_list_modified)
+def _sample_list_response(request):
+    try:
+        return Response(cached_sample_list(_sample_list_data))
+    except Exception as e:
+        return Response({"error": str(e)}, status=500)
 
 
 @api_view(['GET', 'PATCH'])
 def view_sample(request):
 
     if request.method == 'GET':
-        print("Fetching samples...")
-        try:
-            mydata = Sample.objects.filter(available=True)
-            print(f"Fetched {mydata.count()} samples.")
-            serializer = SampleSerializer(mydata, many=True)
-            return Response(serializer.data)
-        except Exception as e:
-            print(f"Error: {str(e)}")  # Print the error for debugging
-            return Response({"error": str(e)}, status=500)
+        return _sample_list_response(request)
     elif request.method == 'PATCH':
         sample_obj = Sample.objects.get(pk=request.data.get('id'))
         serializer = SampleSerializer(
@@ -32,6 +131,7 @@ def view_sample(request):
 
 
 @api_view(['POST'])
+@parser_classes(IMAGE_PARSERS)
 def view_image(request):
     serializer = SampleImageSerializer(data=request.data)
     if serializer.is_valid():
@@ -39,9 +139,147 @@ def view_image(request):
         return Response({'msg': 'Image created successfully', 'data': serializer.data}, status=status.HTTP_201_CREATED)
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+@api_view(['POST'])
+def view_image_batch(request, sample_id):
+    """Muchos frames de una muestra en una sola petición.
+
+    Acepta ``multipart/form-data`` (campo ``images`` repetido) o el cuerpo
+    entero como ``application/x-tar`` (también .tar.gz) o
+    ``application/zip``.
+    """
+    sample = get_object_or_404(Sample, pk=sample_id)
+    content_type = request.content_type.split(';')[0].strip()
+    # sin cuerpo DRF deja ``stream`` a None: archivo vacío ⇒ 400
+    body = request.stream or BytesIO()
+    if content_type in ('application/x-tar', 'application/gzip',
+                        'application/x-gzip'):
+        frames = iter_tar(body)
+    elif content_type == 'application/zip':
+        frames = iter_zip(body)
+    elif content_type == 'multipart/form-data':
+        frames = iter_multipart(request.FILES.getlist('images'))
+    else:
+        return Response({'error': f'Unsupported content type: {content_type}'},
+                        status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    try:
+        created, errors = bulk_ingest(sample, frames)
+    except (tarfile.TarError, zipfile.BadZipFile) as exc:
+        return Response({'error': f'Invalid archive: {exc}'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    return Response({'msg': f'{len(created)} images created',
+                     'created': created, 'errors': errors},
+                    status=status.HTTP_201_CREATED if created
+                    else status.HTTP_400_BAD_REQUEST)
+
+# ─── Subida reanudable ───────────────────────────────────────────
+# 1. POST upload/ {sample, size, checksum, filename} → sesión (+ offset)
+# 2. PATCH upload/<id>/ con el trozo como cuerpo y ``Upload-Offset``
+# 3. Tras un corte, GET upload/<id>/ (o repetir el POST) da el offset
+#    desde el que seguir. La imagen se crea al llegar el último byte.
+def _session_response(session, status_code=status.HTTP_200_OK):
+    return Response(UploadSessionSerializer(session).data, status=status_code,
+                    headers={'Upload-Offset': str(session.offset),
+                             'Cache-Control': 'no-store'})
+
+
+@api_view(['POST'])
+def upload_session(request):
+    serializer = UploadSessionSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        session, created = open_session(**serializer.validated_data)
+    except ValidationError as exc:
+        return Response({'error': ' '.join(exc.messages)},
+                        status=status.HTTP_400_BAD_REQUEST)
+    return _session_response(session, status.HTTP_201_CREATED if created
+                             else status.HTTP_200_OK)
+
+
+@api_view(['GET', 'PATCH'])
+def upload_chunk(request, pk):
+    session = get_object_or_404(UploadSession, pk=pk)
+    if request.method == 'GET':
+        return _session_response(session)
+
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        return Response({'error': 'Missing or invalid Upload-Offset header.'},
+                        status=status.HTTP_400_BAD_REQUEST)
+    try:
+        session = append_chunk(session, offset, request.stream or BytesIO())
+    except OffsetMismatch as exc:
+        return Response({'error': str(exc), 'offset': exc.offset},
+                        status=status.HTTP_409_CONFLICT,
+                        headers={'Upload-Offset': str(exc.offset)})
+    except ValidationError as exc:
+        session.refresh_from_db()
+        return Response({'error': ' '.join(exc.messages),
+                         'offset': session.offset},
+                        status=status.HTTP_400_BAD_REQUEST,
+                        headers={'Upload-Offset': str(session.offset)})
+    return _session_response(session)
+
+
+# ─── Variantes asíncronas (ASGI) ─────────────────────────────────
+# Bajo ``mysite.asgi`` el cuerpo lo lee el servidor en el bucle de
+# eventos: un microscopio lento no ocupa un hilo mientras envía. Son
+# vistas Django puras (DRF no admite vistas async); mismas respuestas
+# que ``view_sample`` (GET) y ``view_image`` (cuerpo binario).
+async def _asample_list_data():
+    samples = [s async for s in sample_list_queryset()]
+    return SampleSerializer(samples, many=True).data
+
+
+@condition(etag_func=sample_list_etag, last_modified_func=sample_list_modified)
+@require_GET
+async def view_sample_async(request):
+    return JsonResponse(await acached_sample_list(_asample_list_data),
+                        safe=False)
+
+
+@csrf_exempt
+@require_POST
+async def view_image_async(request):
+    """La imagen es el cuerpo; la muestra va en ``?sample=<uuid>``."""
+    # el 413 temprano (antes de recibir el cuerpo) lo da
+    # utils_upload.RequestSizeLimit en mysite.asgi; esto cubre el resto
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid Content-Length header.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+    if length > UPLOAD_MAX_SIZE:
+        return JsonResponse({'error': 'Image too large.'},
+                            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+    try:
+        sample = await Sample.objects.only('id').aget(
+            pk=request.GET.get('sample'))
+    except (Sample.DoesNotExist, ValidationError):
+        return JsonResponse({'sample': ['Invalid sample.']},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        simg = await astore_frame(sample, request)
+    except ValidationError as exc:
+        return JsonResponse({'image': exc.messages},
+                            status=status.HTTP_400_BAD_REQUEST)
+    try:
+        await simg.asave()      # post_save ⇒ ingesta, detección y caché
+    except Exception:
+        simg.image.delete(save=False)
+        raise
+    data = SampleImageSerializer(simg, context={'request': request}).data
+    return JsonResponse({'msg': 'Image created successfully', 'data': data},
+                        status=status.HTTP_201_CREATED)
+
+
 class ImageCreateView(generics.CreateAPIView):
     queryset = SampleImage.objects.all()
     serializer_class = SampleImageSerializer
+    parser_classes = IMAGE_PARSERS
 
     def post(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
@@ -50,6 +288,74 @@ class ImageCreateView(generics.CreateAPIView):
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+
+# ─── Mosaicos en teselas (Deep Zoom) ─────────────────────────────
+# Las teselas de un mosaico no cambian nunca: caché larga e inmutable.
+def _tile_etag(request, pk, level=None, col=None, row=None):
+    if level is None:
+        return f"{pk}-dzi"
+    return f"{pk}-{level}-{col}-{row}"
+
+
+@require_GET
+@cache_control(public=True, max_age=31536000, immutable=True)
+@condition(etag_func=_tile_etag)
+def mosaic_dzi(request, pk):
+    get_object_or_404(SampleImage, pk=pk, is_mosaic=True)
+    path = dzi_path(pk)
+    if not os.path.exists(path):
+        raise Http404("Mosaic has no tiles")
+    return FileResponse(open(path, 'rb'), content_type='application/xml')
+
+
+@require_GET
+@cache_control(public=True, max_age=31536000, immutable=True)
+@condition(etag_func=_tile_etag)
+def mosaic_tile(request, pk, level, col, row):
+    path = tile_path(pk, level, col, row)
+    if not os.path.exists(path):
+        raise Http404("Tile not found")
+    return FileResponse(open(path, 'rb'), content_type='image/jpeg')
+
+
+# ─── Miniaturas para el admin ────────────────────────────────────
+def _thumb_file(request, field, pk, size):
+    # una sola consulta por petición: la usan el ETag y la vista
+    if getattr(request, 'thumb_file', None) is None:
+        if field not in THUMB_FIELDS or size not in THUMB_SIZES:
+            raise Http404("Unknown thumbnail")
+        image = get_object_or_404(
+            SampleImage.objects.only(THUMB_FIELDS[field]), pk=pk)
+        field_file = getattr(image, THUMB_FIELDS[field])
+        if not field_file:
+            raise Http404("Image has no file")
+        request.thumb_file = field_file
+    return request.thumb_file
+
+
+def _thumb_etag(request, field, pk, size):
+    # el nombre del fichero entra en el ETag: la imagen con detecciones
+    # se regenera con otro nombre
+    version = thumbnail_version(_thumb_file(request, field, pk, size))
+    return f"{pk}-{field}-{size}-{version}"
+
+
+@require_GET
+@condition(etag_func=_thumb_etag)
+def thumbnail(request, field, pk, size):
+    field_file = _thumb_file(request, field, pk, size)
+    name = ensure_thumbnail(field_file, size)
+    response = FileResponse(field_file.storage.open(name, 'rb'),
+                            content_type=THUMB_CONTENT_TYPE)
+    if request.GET.get('v') == thumbnail_version(field_file):
+        # URL versionada (thumbnail_url): su contenido ya no cambia
+        patch_cache_control(response, public=True, max_age=31536000,
+                            immutable=True)
+    else:
+        patch_cache_control(response, no_cache=True)
+    return response
+
+
 '''
 def index(request):
     return HttpResponse("Hello, world.")
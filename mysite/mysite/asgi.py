@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
 
 application = get_asgi_application()
+
+# 413 para subidas demasiado grandes antes de que Django lea el cuerpo
+from iaweb.utils_upload import RequestSizeLimit  # noqa: E402
+
+application = RequestSizeLimit(application)
@@ -82,12 +82,39 @@ WSGI_APPLICATION = 'mysite.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+#
+# SQLite por defecto (modo WAL y demás PRAGMAs en iaweb/utils_db.py).
+# PostgreSQL en producción: IAWEB_DB_ENGINE=postgresql + IAWEB_DB_NAME,
+# IAWEB_DB_USER, IAWEB_DB_PASSWORD, IAWEB_DB_HOST, IAWEB_DB_PORT.
+
+DB_ENGINE = os.environ.get('IAWEB_DB_ENGINE', 'sqlite3')
+
+if DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('IAWEB_DB_NAME', 'iaweb'),
+            'USER': os.environ.get('IAWEB_DB_USER', ''),
+            'PASSWORD': os.environ.get('IAWEB_DB_PASSWORD', ''),
+            'HOST': os.environ.get('IAWEB_DB_HOST', ''),
+            'PORT': os.environ.get('IAWEB_DB_PORT', ''),
+            # conexiones persistentes (s); 0 = una por petición
+            'CONN_MAX_AGE': int(os.environ.get('IAWEB_DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {},
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('IAWEB_DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'OPTIONS': {
+                # espera (s) al cerrojo de escritura antes de "database is locked"
+                'timeout': int(os.environ.get('IAWEB_DB_TIMEOUT', 20)),
+            },
+        }
     }
-}
 
 
 # Password validation
@@ -137,3 +164,12 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+
+# Caché (listado de muestras, ver iaweb/utils_cache.py). En fichero para
+# que la compartan todos los procesos del servidor sin servicios externos.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache'),
+    }
+}